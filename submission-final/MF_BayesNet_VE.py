@@ -3,16 +3,21 @@
 '''
 
 # Necessary libraries
+import heapq as pq
 import math
-import copy
 
 # combinatorics
 from itertools import combinations
 
 from MF_DiscreteFactors import Factor
 from MF_Graph import Graph
+from MF_JunctionTree import JunctionTree
+from MF_LRUCache import LRUCache
 import MF_Utils as Utils
 
+# Number of query plans (relevant nodes and elimination order) kept by each BayesNet
+ORDER_CACHE_SIZE = 128
+
 class BayesNet():
     '''Helper class that defines a BayesNet object.'''
 
@@ -27,12 +32,26 @@ class BayesNet():
         if factor_dict is not None:
             self.factors = factor_dict
 
+        # query only runs VE on the factors relevant to the query (set to False to use them all)
+        self.prune = True
+
+        # query plans (relevant nodes and elimination order), keyed by (query vars, evidence vars)
+        self.order_cache = LRUCache(ORDER_CACHE_SIZE)
+
+    def invalidate_orders(self):
+        '''
+        Forgets every cached query plan. Must be called whenever the graph or the factors change,
+        e.g. after editing `self.factors` directly (learnParameters already calls it).
+        '''
+        self.order_cache.clear()
+
     def learnParameters(self, data):
         '''Learns the factors of the defined graph given training data.'''
         graph_t = self.graph.transpose()
         for node, parents in graph_t.adj_list.items():
             f = Utils.estimate_factor(data, node, parents, self.outcome_space)
             self.factors[node] = f
+        self.invalidate_orders()
 
     def joint(self):
         '''Finds the join distribution of this Bayes Network.'''
@@ -44,10 +63,11 @@ class BayesNet():
             accumulator = accumulator.join(factor)
         return accumulator
 
-    def width(self, order):
+    def width(self, order, factors=None):
         '''
         argument 
         `order`, a list of variable names specifying an elimination order.
+        `factors`, the factors to eliminate from (by default, the factors of the network).
 
         Returns the width of the elimination order
             i.e., the number of variables of the largest factor
@@ -55,7 +75,7 @@ class BayesNet():
         # Initialize w, a variable that has a width of the elimination order
         w = 0
         # Let's make a list of tuples, where each tuple is a factor domain
-        factor_list = [f.domain for f in self.factors.values()]
+        factor_list = [f.domain for f in self._factor_list(factors)]
         # We process the factor in elimination order
         for var in order:
             # This is the domain of the new factor.
@@ -90,17 +110,47 @@ class BayesNet():
 
         return w
 
-    def VE(self, order):
+    def cost(self, order, factors=None):
+        '''
+        argument 
+        `order`, a list of variable names specifying an elimination order.
+        `factors`, the factors to eliminate from (by default, the factors of the network).
+
+        Returns the cost of the elimination order
+            i.e., the total number of table cells of the factors joined by VE, one per variable
+        '''
+        c = 0
+        # Like width, we only follow the factor domains
+        factor_list = [set(f.domain) for f in self._factor_list(factors)]
+        for var in order:
+            new_factor_domain = set()
+            updated_factors_list = []
+            for f_dom in factor_list:
+                if var in f_dom:
+                    new_factor_domain.update(f_dom)
+                else:
+                    updated_factors_list.append(f_dom)
+
+            # The joined factor still has var, it is summed out afterwards
+            c += math.prod(len(self.outcome_space[v]) for v in new_factor_domain)
+            new_factor_domain.discard(var)
+            updated_factors_list.append(new_factor_domain)
+            factor_list = updated_factors_list
+
+        return c
+
+    def VE(self, order, factors=None):
         '''
         argument 
         `order`, a list of variable names specifying an elimination order.
+        `factors`, the factors to eliminate from (by default, the factors of the network).
 
         Returns a single factor, the which remains after eliminating all other factors
         '''
 
         # Let's make a copy of factors, so we can freely modify it without destroying the original
         # dictionary
-        factor_list = list(self.factors.values())
+        factor_list = self._factor_list(factors)
         # We process the factors in elimination order
         for var in order:
             # We create an empty factor as an accumulator
@@ -133,18 +183,23 @@ class BayesNet():
             return_factor = return_factor * f
         return return_factor
 
-    def interactionGraph(self):
+    def interactionGraph(self, factors=None):
         '''
-        Returns the interaction graph for this network.
+        Returns the interaction graph for this network (or for the given factors).
         There are two ways to implement this function:
         - Iterate over factors and check which vars are in the same factors
         - Start with the directed graph, make it undirected and moralise it
         '''
+        factor_list = self._factor_list(factors)
         # Initialise an empty graph
         g = Graph()
-        for var in self.factors.keys():
-            g.add_node(var)
-        for factor in self.factors.values():
+        if factors is None:
+            for var in self.factors.keys():
+                g.add_node(var)
+        for factor in factor_list:
+            for var in factor.domain:
+                g.add_node(var)
+        for factor in factor_list:
             # for every pair of vars in the domain
             for var1 in factor.domain:
                 for var2 in factor.domain:
@@ -154,8 +209,9 @@ class BayesNet():
                         g.add_edge(var1, var2, directed=False)
         return g
 
-    def minDegree(self):
-        ig = self.interactionGraph()
+    def minDegree(self, factors=None):
+        '''Returns a min-degree elimination order of the network (or of the given factors).'''
+        ig = self.interactionGraph(factors)
         # Initialize order with empty list. This variable will have the answer in the end of the
         # execution
         order = []
@@ -182,32 +238,178 @@ class BayesNet():
             ig.remove_node(min_var)
         return order
 
-    def query(self, q_vars, **q_evi):
+    def minFill(self, factors=None):
+        '''
+        Returns a min-fill elimination order of the network (or of the given factors), i.e. each
+        step eliminates the variable that adds the fewest edges to the interaction graph.
+        '''
+        return self._greedy_order(lambda var1, var2: 1, factors)
+
+    def weightedMinFill(self, factors=None):
+        '''
+        Returns a weighted-min-fill elimination order of the network (or of the given factors),
+        where each added edge weighs the product of the cardinalities of its variables.
+        '''
+        def weight(var1, var2):
+            return len(self.outcome_space[var1]) * len(self.outcome_space[var2])
+        return self._greedy_order(weight, factors)
+
+    def cheapestOrder(self, factors=None, skipped=()):
+        '''
+        Returns whichever of the minDegree, minFill and weightedMinFill orders has the lowest cost,
+        without the `skipped` variables (e.g. the query and evidence variables).
+        '''
+        orders = [
+            [var for var in heuristic(factors) if var not in skipped]
+            for heuristic in (self.minDegree, self.minFill, self.weightedMinFill) ]
+        return min(orders, key=lambda order: self.cost(order, factors))
+
+    def compile(self, order=None):
+        '''
+        Compiles this network into a JunctionTree, which answers every single-variable query from
+        one calibration. `order` is the elimination order used to triangulate (cheapestOrder by
+        default).
+        '''
+        return JunctionTree(self, order)
+
+    def query(self, q_vars, return_stats=False, **q_evi):
         '''
         A faster VE-based query function
         Returns a factor P(q_vars| q_evi)
-        '''
-        # backup factors dict
-        backup_factors = copy.deepcopy(self.factors)
-        # set evidence on all relevant factors
-        for key, factor in self.factors.items():
-            self.factors[key] = factor.evidence(**q_evi)
 
-        # get minDegree order if order is None
-        order = self.minDegree()
+        With `return_stats`, returns a pair (factor, stats) instead, where stats is a dictionary
+        with the number of factors eliminated ('factors') and pruned ('pruned') by this query.
 
-        # remove any q_vars from order
-        for var in q_vars:
-            order.remove(var)
+        The network itself is never modified, so queries are reentrant, and several threads can
+        query the same network at once.
+        '''
+        # get the relevant nodes and their elimination order, unless this query was already planned
+        nodes, order = self._query_plan(q_vars, q_evi)
+
+        # set evidence on all relevant factors, in a working list (evidence slices are views, so
+        # no table is copied)
+        factors = [self.factors[node].evidence(**q_evi) for node in nodes]
 
         # run VE
-        factor = self.VE(order)
+        factor = self.VE(order, factors)
 
         # marginalise out any vars not in q_vars
         for var in factor.domain:
             if var not in q_vars:
                 factor = factor.marginalize(var)
 
-        self.factors = backup_factors
-
+        if return_stats:
+            stats = { 'factors': len(nodes), 'pruned': len(self.factors) - len(nodes) }
+            return factor.normalize(), stats
         return factor.normalize()
+
+    def _factor_list(self, factors=None):
+        '''Returns the given factors as a new list, or the factors of the network by default.'''
+        if factors is None:
+            return list(self.factors.values())
+        return list(factors)
+
+    def _greedy_order(self, edge_weight, factors=None):
+        '''
+        Returns an elimination order that greedily eliminates the variable with the lowest fill
+        score, i.e. the total `edge_weight(var1, var2)` of the edges its elimination adds. Scores
+        are kept in a heap, and only the scores of the eliminated variable's neighbours (and of
+        their neighbours) are updated after each step.
+        '''
+        ig = self.interactionGraph(factors)
+        neighbours = { var: set(ig.children(var)) for var in ig }
+        position = { var: i for i, var in enumerate(ig) }
+
+        def fill(var):
+            return sum(
+                edge_weight(var1, var2)
+                for var1, var2 in combinations(neighbours[var], 2)
+                if var2 not in neighbours[var1])
+
+        scores = { var: fill(var) for var in neighbours }
+        # ties are broken by the position of the variable in the graph
+        heap = [(score, position[var], var) for var, score in scores.items()]
+        pq.heapify(heap)
+
+        order = []
+        while len(heap) > 0:
+            score, _, var = pq.heappop(heap)
+            # skip eliminated variables, and scores that have changed since they were pushed
+            if var not in scores or scores[var] != score:
+                continue
+            order.append(var)
+            del scores[var]
+
+            # connect the neighbours of var, and remove var from the graph
+            adjacent = neighbours.pop(var)
+            for var1 in adjacent:
+                neighbours[var1].discard(var)
+                neighbours[var1].update(adjacent - {var1})
+
+            affected = set(adjacent)
+            for var1 in adjacent:
+                affected.update(neighbours[var1])
+            for var1 in affected:
+                new_score = fill(var1)
+                if new_score != scores[var1]:
+                    scores[var1] = new_score
+                    pq.heappush(heap, (new_score, position[var1], var1))
+        return order
+
+    def relevant_nodes(self, q_vars, evidence_vars):
+        '''
+        Returns the nodes whose factors can affect P(q_vars | evidence_vars), in network order.
+        Barren nodes (leaves that are neither queried nor observed) are removed repeatedly, then
+        the edges leaving observed nodes are cut, and only the nodes still connected to a query
+        variable are kept, since the others are d-separated from it.
+        '''
+        # pruning needs the graph the factors were learned from
+        if any(node not in self.graph.adj_list for node in self.factors):
+            return list(self.factors)
+
+        # remove barren nodes, until every leaf is queried or observed
+        keep = set(q_vars) | set(evidence_vars)
+        graph_t = self.graph.transpose()
+        num_children = { node: len(children) for node, children in self.graph.adj_list.items() }
+        barren = [node for node, n in num_children.items() if n == 0 and node not in keep]
+        removed = set()
+        while len(barren) > 0:
+            node = barren.pop()
+            removed.add(node)
+            for parent in graph_t.children(node):
+                num_children[parent] -= 1
+                if num_children[parent] == 0 and parent not in keep:
+                    barren.append(parent)
+
+        pruned = Graph({
+            node: [child for child in children if child not in removed]
+            for node, children in self.graph.adj_list.items() if node not in removed })
+        for var in evidence_vars:
+            if var in pruned.adj_list:
+                pruned.remove_outgoing_from(var)
+
+        # keep the nodes connected to a query variable
+        undirected = pruned.convert_to_undirected()
+        connected = set()
+        for var in q_vars:
+            if var not in connected:
+                colour = undirected.dfs(var)
+                connected.update(node for node, c in colour.items() if c != 'white')
+        return [node for node in self.factors if node in connected]
+
+    def _query_plan(self, q_vars, q_evi):
+        '''
+        Returns the plan of a query: the nodes whose factors are eliminated (see relevant_nodes),
+        and the cheapest order of their evidence-reduced factors, without the query and evidence
+        variables. The plan only depends on which variables are queried and observed (not on the
+        observed values), so it is cached by the pair (query vars, evidence vars).
+        '''
+        key = (tuple(q_vars), frozenset(q_evi), self.prune)
+        plan = self.order_cache.get(key)
+        if plan is None:
+            nodes = self.relevant_nodes(q_vars, q_evi) if self.prune else list(self.factors)
+            factors = [self.factors[node].evidence(**q_evi) for node in nodes]
+            order = tuple(self.cheapestOrder(factors, set(q_vars) | set(q_evi)))
+            plan = (tuple(nodes), order)
+            self.order_cache.put(key, plan)
+        return plan
@@ -0,0 +1,226 @@
+'''
+    Helper class that predicts every room of the building at once.
+'''
+
+import numpy as np
+import pandas as pd
+from MF_DiscreteFactors import outcome_index
+from MF_HiddenMarkovModel import BatchedHiddenMarkovModel
+from MF_RoomPredictor import RoomPredictor, decide_light
+from MF_SensorSchema import SensorSchema
+
+class BuildingPredictor:
+    '''
+    Helper class that stacks the HMMs of many RoomPredictors, so that the whole building is advanced
+    with a single vectorized step per tick.
+    '''
+
+    def __init__(
+            self,
+            room_predictors: dict[str, RoomPredictor],
+            update_every: int = None) -> None:
+        '''
+        update_every: with online learning (see `observe`), the number of observations after which
+                the factors are re-normalized. If None, only `update_parameters` does it.
+        '''
+        self.room_predictors = room_predictors
+        self.rooms = list(room_predictors)
+        self.room_index = { room: i for i, room in enumerate(self.rooms) }
+
+        # every room must share the same outcomes, so that the states can be stacked
+        self.outcomes = room_predictors[self.rooms[0]].outcome_space[self.rooms[0]]
+        for room, predictor in room_predictors.items():
+            if predictor.outcome_space[room] != self.outcomes:
+                raise ValueError(f'Room {room} does not share the outcomes {self.outcomes}')
+        self.empty_index = self.outcomes.index('0')
+
+        # stack start states (rooms x states) and transitions (rooms x states x states)
+        start_states = np.stack([
+            room_predictors[room].hmm.state.table for room in self.rooms])
+        transitions = np.stack([
+            self._transition_table(room_predictors[room]) for room in self.rooms])
+        silent_likelihoods = np.stack([
+            room_predictors[room].emission_likelihood() for room in self.rooms])
+
+        self.hmm = BatchedHiddenMarkovModel(start_states, transitions, silent_likelihoods)
+
+        # online learning: ticks run so far, the last (tick, outcome index) observed in each room,
+        # and pending observations
+        self.tick = 0
+        self.last_observed = {}
+        self.update_every = update_every
+        self.num_pending = 0
+        self.stale_rooms = set()
+
+        # most likely outcome index of every room, as of the last prediction
+        self.mle_indices = self.hmm.states.argmax(axis=1)
+
+        self.compile_schema()
+
+    def compile_schema(self) -> None:
+        '''
+        Compiles a SensorSchema over the evidence of every room, and where each room's evidence
+        variables sit in its code array, so that `predict_codes` gets every room's evidence code
+        from one vectorized gather.
+        '''
+        outcome_space = {}
+        for predictor in self.room_predictors.values():
+            for var in predictor.evidence_vars:
+                outcomes = predictor.outcome_space[var]
+                if outcome_space.setdefault(var, outcomes) != outcomes:
+                    raise ValueError(f'Rooms do not share the outcomes of {var}')
+        self.schema = SensorSchema(list(outcome_space), outcome_space)
+
+        # (rooms x evidence vars) gather indices, strides, and codes meaning "missing"; rooms with
+        # fewer evidence vars are padded with a stride of 0
+        width = max(len(predictor.evidence_vars) for predictor in self.room_predictors.values())
+        self.schema_columns = np.zeros((len(self.rooms), width), dtype=np.intp)
+        self.schema_strides = np.zeros((len(self.rooms), width), dtype=np.int64)
+        self.schema_missing = np.zeros((len(self.rooms), width), dtype=np.intp)
+        for i, room in enumerate(self.rooms):
+            predictor = self.room_predictors[room]
+            for j, var in enumerate(predictor.evidence_vars):
+                self.schema_columns[i, j] = self.schema.column_index[var]
+                self.schema_strides[i, j] = predictor.evidence_strides[j]
+                self.schema_missing[i, j] = len(predictor.outcome_space[var])
+
+        # <room>_last columns of the schema, and the rooms they are read from
+        last_rooms = [room for room in self.rooms if room + '_last' in self.schema.column_index]
+        self.last_rooms = np.array([self.room_index[room] for room in last_rooms], dtype=np.intp)
+        self.last_columns = np.array(
+            [self.schema.column_index[room + '_last'] for room in last_rooms], dtype=np.intp)
+
+    @staticmethod
+    def _transition_table(predictor: RoomPredictor) -> np.ndarray:
+        '''Returns the transition table of a room, with axes ordered (room, room_next).'''
+        f = predictor.transition_factor
+        axes = (f.domain.index(predictor.room), f.domain.index(predictor.room + '_next'))
+        return np.transpose(f.table, axes)
+
+    def prediction(self, threshold=0.95, **evidence) -> dict[str, tuple[str, str]]:
+        '''
+        Runs a prediction on the next transition for every room, and returns a dictionary mapping
+        each room to its (prediction, light) pair. Has a side effect of changing the internal state.
+        '''
+        room_codes = [
+            self.room_predictors[room].evidence_code(**evidence) for room in self.rooms]
+        return self._predictions(self._forward(room_codes), threshold)
+
+    def predict_codes(self, codes: np.ndarray, threshold=0.95) -> dict[str, tuple[str, str]]:
+        '''
+        Same as `prediction`, for evidence encoded by `self.schema` (e.g. with `encode_tick`).
+        '''
+        return self._predictions(self._forward(self.room_codes(codes)), threshold)
+
+    def encode_tick(self, sensor_data: dict[str], last_indices: np.ndarray = None) -> np.ndarray:
+        '''
+        Encodes raw sensor data into the schema's (reused) code array, with every <room>_last
+        column set from `last_indices`, the outcome index of each room at the previous tick
+        (by default, the most likely outcomes of the last prediction).
+        '''
+        if last_indices is None:
+            last_indices = self.mle_indices
+        codes = self.schema.encode(sensor_data)
+        codes[self.last_columns] = last_indices[self.last_rooms]
+        return codes
+
+    def room_codes(self, codes: np.ndarray) -> np.ndarray:
+        '''Returns the evidence code of every room, given the schema's code array.'''
+        room_evidence = codes[self.schema_columns]
+        room_evidence = np.where(room_evidence >= 0, room_evidence, self.schema_missing)
+        return np.sum(room_evidence * self.schema_strides, axis=1)
+
+    def _forward(self, room_codes) -> np.ndarray:
+        '''Runs every room forward given its evidence code, and returns the normalized beliefs.'''
+        self.tick += 1
+        likelihoods = np.stack([
+            self.room_predictors[room].code_likelihood(code)
+            for room, code in zip(self.rooms, room_codes)])
+        return self.hmm.forward(likelihoods, normalize=True)
+
+    def forward_silent(self, k=1, threshold=0.95) -> dict[str, tuple[str, str]]:
+        '''
+        Fast-forwards every room over `k` ticks without any evidence (e.g. a sensor outage), with
+        one cached matrix product per room, and returns the predictions like `prediction`.
+        '''
+        self.tick += k
+        states = self.hmm.forward_silent(k, normalize=True)
+        return self._predictions(states, threshold)
+
+    def _predictions(self, states: np.ndarray, threshold) -> dict[str, tuple[str, str]]:
+        '''Maps each room to its (prediction, light) pair, given the (rooms x states) beliefs.'''
+        self.mle_indices = mle_indices = states.argmax(axis=1)
+        predictions = {}
+        for i, room in enumerate(self.rooms):
+            prediction = self.outcomes[mle_indices[i]]
+            light = decide_light(prediction, states[i, self.empty_index], threshold)
+            predictions[room] = (prediction, light)
+
+        return predictions
+
+    def smooth(self, data: pd.DataFrame) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        Computes the smoothed marginals P(room_t | all evidence) of every room over a day of
+        evidence (one row per step, with a column per evidence variable), starting from each room's
+        learned start state. All rooms run in one batched forward-backward pass.
+        Returns a (steps x rooms x states) array, with rooms ordered as in `self.rooms`, and the log
+        likelihood of each room's evidence.
+        '''
+        likelihoods = np.stack([
+            self.room_predictors[room].emission_matrix(data) for room in self.rooms], axis=1)
+        start_states = np.stack([
+            self.room_predictors[room].state_factor.table for room in self.rooms])
+
+        offline_hmm = BatchedHiddenMarkovModel(start_states, self.hmm.transitions)
+        return offline_hmm.smooth(likelihoods)
+
+    def set_state(self, room: str, outcome: str) -> None:
+        '''Sets the state of a room to a known outcome (e.g. as observed by a robot).'''
+        state = np.zeros(len(self.outcomes))
+        state[outcome_index(self.outcomes)[outcome]] = 1
+        self.hmm.set_state(self.room_index[room], state)
+
+    def observe(self, room: str, outcome: str, codes: np.ndarray = None, **evidence) -> None:
+        '''
+        Learns online from a ground-truth outcome of a room at the current tick (e.g. counted by a
+        robot), given the evidence of that tick (or its schema code array, `codes`). The counts are
+        updated straight away, the factors every `update_every` observations.
+
+        A transition is only counted when the room was also observed at the previous tick. The
+        belief at the previous tick is no substitute: counting its expected transitions spreads
+        mass onto moves that never happened, which made online learning cost more on the simulator.
+        '''
+        i = self.room_index[room]
+        predictor = self.room_predictors[room]
+        outcome_code = outcome_index(self.outcomes)[outcome]
+
+        previous_state = None
+        previous = self.last_observed.get(room)
+        if previous is not None and previous[0] == self.tick - 1:
+            previous_state = np.zeros(len(self.outcomes))
+            previous_state[previous[1]] = 1
+        self.last_observed[room] = (self.tick, outcome_code)
+
+        if codes is not None:
+            parent_codes = codes[self.schema_columns[i, :len(predictor.evidence_vars)]]
+            predictor.observe(outcome, previous_state, parent_codes)
+        else:
+            predictor.observe(outcome, previous_state, **evidence)
+        self.stale_rooms.add(room)
+        self.num_pending += 1
+
+        if self.update_every is not None and self.num_pending >= self.update_every:
+            self.update_parameters()
+
+    def update_parameters(self) -> None:
+        '''Re-normalizes the factors of every room observed since the last update.'''
+        for room in self.stale_rooms:
+            predictor = self.room_predictors[room]
+            predictor.update_factors()
+            self.hmm.set_model(
+                self.room_index[room],
+                self._transition_table(predictor),
+                predictor.emission_likelihood())
+
+        self.num_pending = 0
+        self.stale_rooms = set()
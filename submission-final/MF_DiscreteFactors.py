@@ -7,6 +7,17 @@ from itertools import product
 from tabulate import tabulate
 import numpy as np
 
+def outcome_index(outcomes: tuple) -> dict:
+    '''
+    Returns the outcome -> position map of an outcome space. Build it once and keep it, e.g. in
+    `Factor.outcome_codes`, rather than calling this per lookup.
+    '''
+    return { outcome: i for i, outcome in enumerate(outcomes) }
+
+def outcome_codes(domain: tuple, outcome_space) -> dict:
+    '''Returns the outcome -> position map of every variable of a domain.'''
+    return { var: outcome_index(outcome_space[var]) for var in domain }
+
 class Factor:
     '''
     Factors are a generalisation of discrete probability distributions over one or more random
@@ -17,12 +28,17 @@ class Factor:
     
     The probabilities are stored in a n-dimensional numpy array, using the domain and outcomeSpace
     as dimension and row labels respectively.
+
+    Tables may be read-only views shared with another factor (see evidence2), so they must never be
+    written to directly (`f.table[...] = x` raises a ValueError on such a view). Write through
+    `f[...] = x` or `set_many` instead, which copy a shared table first.
     '''
-    def __init__(self, domain: tuple, outcome_space, table=None, trivial=False):
+    def __init__(self, domain: tuple, outcome_space, table=None, trivial=False, codes=None):
         '''
         Inititalise a factor with a given domain and outcomeSpace. 
         All probabilities are set to uniform distribution by default. 
         If trivial=True then it creates a trivial factor (all entries equal to one).
+        `codes` are the outcome -> position maps of the domain, if already built (see join).
         '''
         self.domain = tuple(domain) # tuple of variable names, which may be strings, integers, etc.
 
@@ -36,6 +52,21 @@ class Factor:
 
         self.outcome_space = copy.copy(outcome_space)
 
+        # outcome -> position map of each variable, shared with the factors derived from this one
+        if codes is None:
+            codes = outcome_codes(self.domain, outcome_space)
+        self.outcome_codes = codes
+
+    def _codes(self, var) -> dict:
+        '''
+        Returns the outcome -> position map of a variable. Variables renamed after the factor was
+        built (e.g. by HiddenMarkovModel.forward) get their map on first use.
+        '''
+        codes = self.outcome_codes.get(var)
+        if codes is None:
+            codes = self.outcome_codes[var] = outcome_index(self.outcome_space[var])
+        return codes
+
     def __getitem__(self, outcomes):
         '''
         This function allows direct access to individual probabilities.
@@ -49,9 +80,7 @@ class Factor:
             outcomes = (outcomes,)
 
         # convert outcomes into array indicies
-        indices = tuple(
-            self.outcome_space[var].index(outcomes[i])
-            for i, var in enumerate(self.domain))
+        indices = tuple(self._codes(var)[outcomes[i]] for i, var in enumerate(self.domain))
         return self.table[indices]
 
     def __setitem__(self, outcomes, new_value):
@@ -60,15 +89,65 @@ class Factor:
         '''
         if not isinstance(outcomes, tuple):
             outcomes = (outcomes,)
-        indices = tuple(
-            self.outcome_space[var].index(outcomes[i])
-            for i, var in enumerate(self.domain))
-        self.table[indices] = new_value
+        indices = tuple(self._codes(var)[outcomes[i]] for i, var in enumerate(self.domain))
+
+        self._writeable_table()[indices] = new_value
+
+    def _writeable_table(self) -> np.ndarray:
+        '''
+        Returns the table, ready to be written to. Tables shared with another factor (see
+        evidence2) are copied before the first write.
+        '''
+        if isinstance(self.table, np.ndarray) and not self.table.flags.writeable:
+            self.table = self.table.copy()
+        return self.table
+
+    def _indices_many(self, outcomes) -> tuple[np.ndarray]:
+        '''
+        Converts an array of outcome tuples (one row per entry, one column per domain variable) into
+        a tuple of index arrays, one per axis of the table.
+        '''
+        outcomes = np.asarray(outcomes, dtype=object).reshape(-1, len(self.domain))
+        indices = []
+        for i, var in enumerate(self.domain):
+            codes = self._codes(var)
+            indices.append(np.fromiter(
+                (codes[outcome] for outcome in outcomes[:, i]), dtype=np.intp, count=len(outcomes)))
+        return tuple(indices)
+
+    def get_many(self, outcomes) -> np.ndarray:
+        '''
+        Bulk version of `factor[outcome]`. Takes an array of outcome tuples and returns an array with
+        the probability of each.
+        '''
+        return self.table[self._indices_many(outcomes)]
+
+    def set_many(self, outcomes, new_values) -> None:
+        '''
+        Bulk version of `factor[outcome] = value`. Takes an array of outcome tuples and sets each one
+        to the matching entry of `new_values` (or to `new_values` itself, if it is a scalar).
+        '''
+        self._writeable_table()[self._indices_many(outcomes)] = new_values
+
+    def set_index(self, index, new_values) -> None:
+        '''
+        Sets the entries of the table at a numpy index (in domain order), e.g. a whole row given the
+        outcome indices of its first variables. Tables shared with another factor are copied first.
+        '''
+        self._writeable_table()[index] = new_values
 
     def join(self, other):
         '''
         This function multiplies two factors: one in this object and the factor in `other`
         '''
+        # sparse factors know how to join with dense factors without expanding themselves
+        if isinstance(other, SparseFactor):
+            return other.join(self)
+
+        # joining with a log-space factor gives a log-space factor
+        if isinstance(other, LogFactor) and not isinstance(self, LogFactor):
+            return LogFactor.from_factor(self).join(other)
+
         # confirm that any shared variables have the same outcomeSpace
         for var in set(other.domain).intersection(set(self.domain)):
             if self.outcome_space[var] != other.outcome_space[var]:
@@ -103,7 +182,7 @@ class Factor:
         # Now that the arrays are all set up, we can rely on numpy broadcasting to work out which
         # numbers need to be multiplied.
         # https://numpy.org/doc/stable/user/basics.broadcasting.html
-        new_table = self_t * other_t
+        new_table = self._product(self_t, other_t)
 
         # The final step is to create the new outcomeSpace
         new_outcome_space = self.outcome_space.copy()
@@ -111,7 +190,15 @@ class Factor:
 
         # in the following line, `self.__class__` is the same as `Factor`
         # (except it doesn't break things when subclassing)
-        return self.__class__(tuple(new_dom), new_outcome_space, table=new_table)
+        # both factors already have the outcome -> position maps of the new domain, merged in the
+        # same order as the outcome spaces so that they agree
+        codes = self.outcome_codes | other.outcome_codes
+        return self.__class__(tuple(new_dom), new_outcome_space, table=new_table, codes=codes)
+
+    @staticmethod
+    def _product(self_t: np.ndarray, other_t: np.ndarray) -> np.ndarray:
+        '''Combines two aligned tables when joining.'''
+        return self_t * other_t
 
     def evidence(self, **kwargs):
         '''
@@ -126,17 +213,21 @@ class Factor:
         Sets evidence by removing the observed variables from the factor domain
         This function must be used to set evidence on all factors before joining,
         because it removes the relevant variable from the factor. 
+
+        No copy is made: the new table is a read-only numpy view of this factor's table, and the
+        outcome space is shared. Writing to the new factor with `f[...] = x` or `set_many` copies
+        the table first, so this factor is never modified.
         '''
-        f = self.copy()
         evi = kwargs
 
         indices = tuple(
-            self.outcome_space[v].index(evi[v])
-            if v in evi else slice(None)
-            for v in self.domain)
-        f.table = f.table[indices]
-        f.domain = tuple(v for v in f.domain if v not in evi)
-        return f
+            self._codes(v)[evi[v]] if v in evi else slice(None) for v in self.domain)
+        table = self.table[indices]
+        if isinstance(table, np.ndarray):
+            table = table.view()
+            table.flags.writeable = False
+
+        return self._share(tuple(v for v in self.domain if v not in evi), table)
 
     def marginalize(self, var):
         '''
@@ -151,9 +242,38 @@ class Factor:
         axis = self.domain.index(var)
         new_table = np.sum(self.table, axis=axis)
 
-        # in the following line, `self.__class__` is the same as `Factor`
-        # (except it doesn't break things when subclassing)
-        return self.__class__(tuple(new_dom),self.outcome_space, new_table)
+        return self._share(tuple(new_dom), new_table)
+
+    def maximize(self, var, return_prev=False):
+        '''
+        This function removes a variable from the domain, and maximizes over that variable in the
+        table (max-product). If return_prev is True, also returns an array with the index of the
+        maximizing outcome of `var` for each entry of the new table.
+        '''
+
+        # create new domain
+        new_dom = list(self.domain)
+        new_dom.remove(var)
+
+        # remove an axis of the table by maximizing over it
+        axis = self.domain.index(var)
+        new_table = np.max(self.table, axis=axis)
+        f = self._share(tuple(new_dom), new_table)
+
+        if return_prev:
+            return f, np.argmax(self.table, axis=axis)
+        return f
+
+    def _share(self, domain: tuple, table):
+        '''
+        Creates a factor of the same class with the given domain and table, sharing this factor's
+        outcome space instead of copying it. Outcome spaces are never modified once a factor is
+        created, so sharing them is safe.
+        '''
+        f = copy.copy(self)
+        f.domain = domain
+        f.table = table
+        return f
 
     def copy(self):
         '''Returns a deep copy of self.'''
@@ -185,3 +305,339 @@ class Factor:
             table.append(row)
         header = list(self.domain) + ['Pr']
         return tabulate(table, headers=header, tablefmt='fancy_grid') + '\n'
+
+def logsumexp(table: np.ndarray, axis=None) -> np.ndarray:
+    '''
+    Computes log(sum(exp(table))) along an axis without overflow or underflow, by factoring out the
+    largest entry. Slices that are all -inf (probability zero) give -inf.
+    '''
+    table = np.asarray(table)
+    largest = np.max(table, axis=axis, keepdims=True)
+    largest = np.where(np.isfinite(largest), largest, 0)
+    with np.errstate(divide='ignore'):
+        result = np.log(np.sum(np.exp(table - largest), axis=axis, keepdims=True)) + largest
+    if axis is None:
+        return result.reshape(())[()]
+    return np.squeeze(result, axis=axis)
+
+class LogFactor(Factor):
+    '''
+    A Factor whose table holds log probabilities, so that long products (e.g. an HMM over many days)
+    do not underflow. Joining adds tables, marginalizing uses logsumexp and maximizing is unchanged
+    (the log is monotonic), so it can be used anywhere a Factor is.
+    '''
+    def __init__(self, domain: tuple, outcome_space, table=None, trivial=False, codes=None):
+        '''
+        Inititalise a log-space factor. If a table is given, it must already hold log probabilities.
+        By default, the factor is uniform (or all zeros, i.e. probability one, if trivial=True).
+        '''
+        super().__init__(domain, outcome_space, table, trivial, codes)
+        if table is None:
+            self.table = np.log(self.table)
+
+    @classmethod
+    def from_factor(cls, factor):
+        '''
+        Converts a probability factor into a log-space factor. Sparse factors are expanded into dense
+        ones first, which can use a lot of memory.
+        '''
+        if isinstance(factor, LogFactor):
+            return factor
+        if isinstance(factor, SparseFactor):
+            factor = factor.to_factor()
+        with np.errstate(divide='ignore'):
+            table = np.log(factor.table)
+        return cls(factor.domain, factor.outcome_space, table=table)
+
+    def to_factor(self) -> Factor:
+        '''Converts this factor back into a probability factor.'''
+        return Factor(self.domain, self.outcome_space, table=np.exp(self.table))
+
+    def join(self, other):
+        '''
+        Multiplies two factors, i.e. adds their log tables. `other` is converted into log space
+        first if needed.
+        '''
+        return super().join(LogFactor.from_factor(other))
+
+    @staticmethod
+    def _product(self_t: np.ndarray, other_t: np.ndarray) -> np.ndarray:
+        '''Combines two aligned log tables when joining.'''
+        return self_t + other_t
+
+    def marginalize(self, var):
+        '''
+        Removes a variable from the domain, and sums over that variable in (non-log) space.
+        '''
+        new_dom = list(self.domain)
+        new_dom.remove(var)
+
+        axis = self.domain.index(var)
+        return self._share(tuple(new_dom), logsumexp(self.table, axis=axis))
+
+    def normalize(self):
+        '''
+        Normalise the factor so that all probabilities add up to 1
+        '''
+        self.table = self.table - logsumexp(self.table)
+        return self
+
+    def __str__(self):
+        '''
+        String representation of this factor, showing probabilities rather than log probabilities.
+        '''
+        return str(self.to_factor())
+
+class SparseFactor:
+    '''
+    A conditional probability table that only stores the parent configurations seen in training.
+    Every other configuration shares the same `default` row (usually the smoothed prior).
+
+    The domain is split in two parts:
+    - `sparse_domain`: the parent variables. Each stored row is identified by one row of `keys`,
+        which holds the outcome indices of these variables.
+    - `dense_domain`: the remaining variables (usually just the child). Each stored row is a numpy
+        array over these variables, and so is `default`.
+
+    Only `evidence`, `marginalize`, `expand`, `join` (with dense factors) and `normalize` are
+    supported. When the sparse domain becomes empty, a dense `Factor` is returned instead.
+    '''
+    def __init__(
+            self,
+            sparse_domain: tuple,
+            dense_domain: tuple,
+            outcome_space,
+            keys: np.ndarray,
+            values: np.ndarray,
+            default: np.ndarray):
+        '''
+        Initialise a sparse factor. `keys` has one row of outcome indices (over `sparse_domain`) for
+        each stored configuration, `values` has the matching rows, and `default` is the row used for
+        every configuration that is not stored.
+        '''
+        self.sparse_domain = tuple(sparse_domain)
+        self.dense_domain = tuple(dense_domain)
+        self.domain = self.sparse_domain + self.dense_domain
+        self.outcome_space = copy.copy(outcome_space)
+        self.outcome_codes = outcome_codes(self.domain, outcome_space)
+
+        self.keys = np.asarray(keys).reshape(-1, len(self.sparse_domain))
+        self.values = np.asarray(values)
+        self.default = np.asarray(default)
+
+    # outcome -> position map of a variable, as in Factor
+    _codes = Factor._codes
+
+    def _build(self, sparse_domain, dense_domain, keys, values, default):
+        '''
+        Creates the result of an operation, collapsing into a dense Factor once no sparse variables
+        are left (there is then at most one stored row).
+        '''
+        if len(sparse_domain) == 0:
+            table = values[0] if len(values) > 0 else default
+            return Factor(dense_domain, self.outcome_space, table=table)
+        return self.__class__(sparse_domain, dense_domain, self.outcome_space, keys, values, default)
+
+    def num_configurations(self) -> int:
+        '''Returns the number of parent configurations, stored or not.'''
+        return int(np.prod([len(self.outcome_space[var]) for var in self.sparse_domain]))
+
+    def __getitem__(self, outcomes):
+        '''
+        Direct access to individual probabilities, as in `Factor`. Configurations that were not
+        stored return the default row.
+        '''
+        if not isinstance(outcomes, tuple):
+            outcomes = (outcomes,)
+
+        indices = [self._codes(var)[outcomes[i]] for i, var in enumerate(self.domain)]
+        num_sparse = len(self.sparse_domain)
+
+        match = np.flatnonzero((self.keys == indices[:num_sparse]).all(axis=1))
+        row = self.values[match[0]] if len(match) > 0 else self.default
+        return row[tuple(indices[num_sparse:])]
+
+    def evidence(self, **kwargs):
+        '''
+        Sets evidence by removing the observed variables from the factor domain.
+        Observed parents filter the stored rows, observed dense variables slice every row.
+        '''
+        evi = kwargs
+
+        # slice the dense part of every row
+        dense_index = tuple(
+            self._codes(v)[evi[v]] if v in evi else slice(None) for v in self.dense_domain)
+        values = self.values[(slice(None),) + dense_index]
+        default = self.default[dense_index]
+        dense_domain = tuple(v for v in self.dense_domain if v not in evi)
+
+        # keep only the stored rows that agree with the evidence
+        mask = np.ones(len(self.keys), dtype=np.bool_)
+        kept = []
+        for i, v in enumerate(self.sparse_domain):
+            if v in evi:
+                mask &= self.keys[:, i] == self._codes(v)[evi[v]]
+            else:
+                kept.append(i)
+        keys = self.keys[mask][:, kept]
+        values = values[mask]
+        sparse_domain = tuple(self.sparse_domain[i] for i in kept)
+
+        return self._build(sparse_domain, dense_domain, keys, values, default)
+
+    def evidence2(self, **kwargs):
+        '''Alias of `evidence`, to match the `Factor` interface.'''
+        return self.evidence(**kwargs)
+
+    def marginalize(self, var):
+        '''
+        Removes a variable from the domain by summing over it.
+        Summing out a parent merges stored rows that only differ in that parent, and counts every
+        missing configuration as one default row.
+        '''
+        if var in self.dense_domain:
+            axis = self.dense_domain.index(var)
+            dense_domain = tuple(v for v in self.dense_domain if v != var)
+            return self._build(
+                self.sparse_domain,
+                dense_domain,
+                self.keys,
+                np.sum(self.values, axis=axis + 1),
+                np.sum(self.default, axis=axis))
+
+        axis = self.sparse_domain.index(var)
+        num_outcomes = len(self.outcome_space[var])
+        sparse_domain = tuple(v for v in self.sparse_domain if v != var)
+
+        # group stored rows by their remaining parent configuration
+        keys = np.delete(self.keys, axis, axis=1)
+        keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+
+        values = np.zeros((len(keys),) + self.default.shape)
+        np.add.at(values, inverse, self.values)
+        num_stored = np.bincount(inverse, minlength=len(keys))
+        num_stored = num_stored.reshape((-1,) + (1,) * self.default.ndim)
+        values += (num_outcomes - num_stored) * self.default
+
+        return self._build(sparse_domain, self.dense_domain, keys, values, num_outcomes * self.default)
+
+    def expand(self, variables):
+        '''
+        Moves some sparse variables into the dense domain (in front of the other dense variables).
+        Stored rows that only differ in those variables are merged into one row over them, where
+        the configurations that were not stored hold the default row. Only the stored rows are
+        expanded, so the result stays as sparse as the remaining variables allow.
+        '''
+        axes = [self.sparse_domain.index(var) for var in variables]
+        kept = [i for i in range(len(self.sparse_domain)) if i not in axes]
+        sizes = tuple(len(self.outcome_space[var]) for var in variables)
+
+        # group stored rows by their remaining parent configuration
+        if len(kept) > 0:
+            keys, inverse = np.unique(self.keys[:, kept], axis=0, return_inverse=True)
+            inverse = inverse.reshape(-1)
+        else:
+            keys = np.zeros((min(len(self.keys), 1), 0), dtype=self.keys.dtype)
+            inverse = np.zeros(len(self.keys), dtype=np.intp)
+
+        values = np.empty((len(keys),) + sizes + self.default.shape)
+        values[...] = self.default
+        values[(inverse,) + tuple(self.keys[:, axes].T)] = self.values
+        default = np.empty(sizes + self.default.shape)
+        default[...] = self.default
+
+        return self._build(
+            tuple(self.sparse_domain[i] for i in kept),
+            tuple(variables) + self.dense_domain,
+            keys,
+            values,
+            default)
+
+    def join(self, other):
+        '''
+        Multiplies this factor with a dense factor. Sparse variables of the dense factor are moved
+        into the dense part first (see `expand`). Then every row (and the default) is multiplied on
+        its own, so the result stays sparse over the other sparse variables.
+        '''
+        if isinstance(other, LogFactor):
+            return LogFactor.from_factor(self).join(other)
+        if isinstance(other, SparseFactor):
+            raise TypeError('Cannot join two sparse factors. '
+                            'Expand one of them with to_factor() first')
+        shared = tuple(var for var in self.sparse_domain if var in other.domain)
+        if len(shared) > 0:
+            return self.expand(shared).join(other)
+
+        for var in set(other.domain).intersection(set(self.domain)):
+            if self.outcome_space[var] != other.outcome_space[var]:
+                raise IndexError('Incompatible outcomeSpaces. '
+                                 'Make sure you set the same evidence on all factors')
+
+        new_outcome_space = self.outcome_space.copy()
+        new_outcome_space.update(other.outcome_space)
+
+        # new variables are appended to the dense part
+        new_dom = self.dense_domain + tuple(v for v in other.domain if v not in self.dense_domain)
+        num_new_axes = len(new_dom) - len(self.dense_domain)
+
+        # put the other table's axes in the same order as the new dense domain, with size 1 axes for
+        # variables it does not have
+        order = sorted(range(len(other.domain)), key=lambda i: new_dom.index(other.domain[i]))
+        other_shape = [1] * len(new_dom)
+        for var, size in zip(other.domain, other.table.shape):
+            other_shape[new_dom.index(var)] = size
+        other_t = np.transpose(other.table, order).reshape(other_shape)
+
+        values = self.values.reshape(self.values.shape + (1,) * num_new_axes) * other_t
+        default = self.default.reshape(self.default.shape + (1,) * num_new_axes) * other_t
+
+        return self.__class__(
+            self.sparse_domain, new_dom, new_outcome_space, self.keys, values, default)
+
+    def to_factor(self) -> Factor:
+        '''Expands this factor into a dense Factor. Beware: this can use a lot of memory.'''
+        shape = tuple(len(self.outcome_space[var]) for var in self.sparse_domain)
+        table = np.empty(shape + self.default.shape)
+        table[...] = self.default
+        table[tuple(self.keys.T)] = self.values
+        return Factor(self.domain, self.outcome_space, table=table)
+
+    def copy(self):
+        '''Returns a deep copy of self.'''
+        return copy.deepcopy(self)
+
+    def normalize(self):
+        '''
+        Normalise the factor so that all probabilities (stored or not) add up to 1
+        '''
+        num_default_rows = self.num_configurations() - len(self.keys)
+        total = np.sum(self.values) + num_default_rows * np.sum(self.default)
+        self.values = self.values / total
+        self.default = self.default / total
+        return self
+
+    def __mul__(self, other):
+        '''
+        Override the * operator, so that it can be used to join factors
+        '''
+        return self.join(other)
+
+    def __str__(self):
+        '''
+        String representation of the stored rows, followed by the default row.
+        '''
+        table = []
+        outcome_spaces = [self.outcome_space[var] for var in self.dense_domain]
+        for key, row in zip(self.keys, self.values):
+            parents = [self.outcome_space[var][i] for var, i in zip(self.sparse_domain, key)]
+            for outcome in product(*outcome_spaces):
+                indices = tuple(
+                    self._codes(var)[outcome[i]] for i, var in enumerate(self.dense_domain))
+                table.append(parents + list(outcome) + [row[indices]])
+        for outcome in product(*outcome_spaces):
+            indices = tuple(
+                self._codes(var)[outcome[i]] for i, var in enumerate(self.dense_domain))
+            table.append(['*'] * len(self.sparse_domain) + list(outcome) + [self.default[indices]])
+        header = list(self.domain) + ['Pr']
+        return tabulate(table, headers=header, tablefmt='fancy_grid') + '\n'
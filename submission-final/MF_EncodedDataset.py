@@ -0,0 +1,161 @@
+'''
+    Helper class to store training data as small integer codes.
+'''
+
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+def encode_column(values, outcomes: tuple) -> np.ndarray:
+    '''
+    Integer-encodes a column against its outcome space, i.e. each value is replaced by its position
+    in `outcomes`. Values that are not in the outcome space (including NaN) are encoded as -1.
+    Categorical columns whose categories already are the outcome space reuse their codes.
+    '''
+    if isinstance(getattr(values, 'dtype', None), pd.CategoricalDtype):
+        if tuple(values.cat.categories) == tuple(outcomes):
+            return values.cat.codes.to_numpy()
+    return pd.Categorical(np.asarray(values), categories=list(outcomes)).codes
+
+class EncodedDataset:
+    '''
+    Training data encoded once, as one small integer code per cell, with a single outcome space
+    (vocabulary) shared by every column reader.
+
+    The codes are stored column by column (Fortran order), so each column is a contiguous view and
+    many RoomPredictors can read the same dataset without copying it. Missing values are coded -1.
+    '''
+
+    def __init__(
+            self,
+            data: pd.DataFrame,
+            outcomes_remap: dict[str, tuple] = None,
+            columns: list[str] = None,
+            day_lengths: list[int] = None) -> None:
+        '''
+        Encodes `columns` of `data` (all columns by default). Columns in `outcomes_remap` use the
+        given outcomes, others use their values in order of appearance.
+        If `data` holds several days one after the other, `day_lengths` gives the number of rows of
+        each day, so that no transition is learned across two days. By default, it is one day.
+        '''
+        if day_lengths is None:
+            day_lengths = [len(data)]
+        if sum(day_lengths) != len(data):
+            raise ValueError('day_lengths must add up to the number of rows')
+        self.day_starts = np.cumsum([0] + list(day_lengths[:-1]))
+
+        if columns is None:
+            columns = list(data.columns)
+        if outcomes_remap is None:
+            outcomes_remap = {}
+
+        self.columns = list(columns)
+        self.column_index = { column: i for i, column in enumerate(self.columns) }
+
+        # Setup outcome space
+        self.outcome_space = {}
+        for column in self.columns:
+            if column in outcomes_remap:
+                self.outcome_space[column] = tuple(outcomes_remap[column])
+            else:
+                self.outcome_space[column] = tuple(data[column].dropna().unique())
+
+        # Use the smallest signed integer type that fits every outcome (and -1)
+        max_outcomes = max((len(outcomes) for outcomes in self.outcome_space.values()), default=1)
+        dtype = np.min_scalar_type(-max_outcomes)
+
+        self.codes = np.empty((len(data), len(self.columns)), dtype=dtype, order='F')
+        for i, column in enumerate(self.columns):
+            self.codes[:, i] = encode_column(data[column], self.outcome_space[column])
+
+    def __len__(self) -> int:
+        '''Returns the number of rows.'''
+        return self.codes.shape[0]
+
+    def __getitem__(self, column: str) -> np.ndarray:
+        '''Returns the codes of a column, as a read-only view.'''
+        view = self.codes[:, self.column_index[column]]
+        view.flags.writeable = False
+        return view
+
+    def codes_of(self, column: str, outcomes: tuple) -> np.ndarray:
+        '''
+        Returns the codes of a column against the given outcome space. This is a view of the stored
+        codes when the outcome space matches the dataset's, and a translated copy otherwise.
+        '''
+        codes = self[column]
+        own_outcomes = self.outcome_space[column]
+        if tuple(outcomes) == own_outcomes:
+            return codes
+
+        positions = { outcome: i for i, outcome in enumerate(outcomes) }
+        translate = np.array([positions.get(outcome, -1) for outcome in own_outcomes] + [-1])
+        return translate[codes]
+
+    def same_day_pairs(self) -> np.ndarray:
+        '''
+        Returns a boolean array with one entry per pair of consecutive rows (t, t+1), which is True
+        when both rows belong to the same day.
+        '''
+        same_day = np.ones(max(len(self) - 1, 0), dtype=np.bool_)
+        same_day[self.day_starts[1:] - 1] = False
+        return same_day
+
+    def to_shared_memory(self) -> tuple[shared_memory.SharedMemory, dict]:
+        '''
+        Copies the codes into a new shared memory block, so that other processes can read the
+        dataset without copying it. Returns the block, which the caller must close and unlink once
+        done, and the arguments to pass to `from_shared_memory` in the other processes.
+        '''
+        block = shared_memory.SharedMemory(create=True, size=max(self.codes.nbytes, 1))
+        shared_codes = np.ndarray(self.codes.shape, self.codes.dtype, buffer=block.buf, order='F')
+        shared_codes[...] = self.codes
+
+        description = {
+            'name': block.name,
+            'shape': self.codes.shape,
+            'dtype': self.codes.dtype.str,
+            'columns': self.columns,
+            'outcome_space': self.outcome_space,
+            'day_starts': self.day_starts,
+        }
+        return block, description
+
+    @classmethod
+    def from_shared_memory(
+            cls,
+            name: str,
+            shape: tuple[int],
+            dtype: str,
+            columns: list[str],
+            outcome_space: dict[str, tuple],
+            day_starts: np.ndarray):
+        '''
+        Attaches to a dataset shared with `to_shared_memory`. The codes are read straight from the
+        shared block, which stays open for as long as the dataset exists. The process must share
+        the resource tracker of the block's creator (e.g. be forked after it started), otherwise its
+        own tracker reports the block leaked at exit, and unlinks it.
+        '''
+        dataset = cls.__new__(cls)
+        dataset.columns = list(columns)
+        dataset.column_index = { column: i for i, column in enumerate(dataset.columns) }
+        dataset.outcome_space = outcome_space
+        dataset.day_starts = day_starts
+
+        dataset.shared_block = shared_memory.SharedMemory(name=name)
+        # attaching registers the block with the resource tracker again, which is harmless as long
+        # as this process shares the tracker of the block's creator (whose unlink unregisters it)
+        dataset.codes = np.ndarray(shape, np.dtype(dtype), buffer=dataset.shared_block.buf, order='F')
+        dataset.codes.flags.writeable = False
+        return dataset
+
+    def detach(self) -> None:
+        '''
+        Closes the shared block of a dataset attached with `from_shared_memory` (the block itself is
+        unlinked by its creator). The dataset cannot be read afterwards.
+        '''
+        # the codes view must go first: a block cannot be closed while it is exported
+        self.codes = None
+        self.shared_block.close()
+        self.shared_block = None
@@ -3,7 +3,55 @@
 '''
 
 import numpy as np
-from MF_DiscreteFactors import Factor
+from MF_DiscreteFactors import Factor, LogFactor, logsumexp
+
+class MatrixPowers():
+    '''
+    Helper class that memoizes the powers of a square matrix (or of a stack of them), e.g. to run
+    an HMM over many steps at once. Only the powers of two are kept (one per bit of the largest k
+    asked for), and any other power is their product, as in binary exponentiation. Each power is
+    stored rescaled so that its largest entry is 1, together with the log of the scale, so that
+    high powers neither underflow nor overflow.
+    '''
+
+    def __init__(self, matrices: np.ndarray):
+        '''matrices: a (... x states x states) array.'''
+        # squares[i] is the (2 ** i)-th power
+        self.squares = [self._rescale(np.asarray(matrices, dtype=np.float64), 0.0)]
+
+    @staticmethod
+    def _rescale(matrices: np.ndarray, log_scales) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        Divides each matrix by its largest entry, and adds the log of it to the log scales. An
+        all-zero matrix is left as is, with a log scale of -inf.
+        '''
+        largest = np.max(matrices, axis=(-2, -1), keepdims=True)
+        with np.errstate(divide='ignore'):
+            log_largest = np.log(largest[..., 0, 0])
+        return matrices / np.where(largest > 0, largest, 1.0), log_scales + log_largest
+
+    @staticmethod
+    def _multiply(first: tuple, second: tuple) -> tuple[np.ndarray, np.ndarray]:
+        '''Multiplies two rescaled powers.'''
+        return MatrixPowers._rescale(np.matmul(first[0], second[0]), first[1] + second[1])
+
+    def power(self, k: int) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        Returns the k-th power (k >= 1) as a pair (matrices, log_scales), where the actual power is
+        exp(log_scales) * matrices. Powers of two are returned as they are kept, other powers take
+        one product per extra bit set in k.
+        '''
+        if k < 1:
+            raise ValueError('Only powers k >= 1 are supported')
+
+        while len(self.squares) < k.bit_length():
+            self.squares.append(self._multiply(self.squares[-1], self.squares[-1]))
+
+        result = None
+        for i, square in enumerate(self.squares[:k.bit_length()]):
+            if k >> i & 1:
+                result = square if result is None else self._multiply(result, square)
+        return result
 
 class HiddenMarkovModel():
     '''Helper class that stores a Hidden Markov Model.'''
@@ -13,9 +61,10 @@ class HiddenMarkovModel():
             start_state: Factor,
             transition: Factor,
             emission: Factor,
-            variable_remap: dict):
+            variable_remap: dict,
+            log_space=False):
         '''
-        Takes 3 arguments:
+        Takes 5 arguments:
         - start_state: a factor representing the start state.
             E.g. domain might be ('A', 'B', 'C')
         - transition: a factor that represents the transition probs.
@@ -25,18 +74,49 @@ class HiddenMarkovModel():
         - variable_remap: a dictionary that maps new variable names to old variable names, to reset
                 the state after transition.
             E.g. {'A_next':'A', 'B_next':'B', 'C_next':'C'}
+        - log_space: if True, all factors are converted into LogFactors, so that unnormalized
+                filtering and viterbi can run over many steps without underflowing. The state is
+                then a LogFactor too (use `state.to_factor()` to get probabilities).
         '''
+        if log_space:
+            start_state = LogFactor.from_factor(start_state)
+            transition = LogFactor.from_factor(transition)
+            emission = LogFactor.from_factor(emission)
+
         self.state = start_state
         self.transition = transition
         self.emission = emission
         self.remap = variable_remap
+        self.log_space = log_space
 
-        self.history = []
-        self.prev_history = []
+        # viterbi scores and backpointers, (steps x states) arrays filled by viterbi_decode
+        self.scores = None
+        self.backpointers = None
+
+        # memoized powers of the evidence-free step, cleared by set_factors
+        self.silent_powers = None
+
+    def set_factors(self, transition: Factor = None, emission: Factor = None) -> None:
+        '''
+        Replaces the transition and/or emission factor (converting them into LogFactors in log
+        space). Must also be called, with no arguments, after writing to their tables in place, so
+        that the memoized powers of forward_silent are rebuilt.
+        '''
+        convert = LogFactor.from_factor if self.log_space else (lambda factor: factor)
+        if transition is not None:
+            self.transition = convert(transition)
+        if emission is not None:
+            self.emission = convert(emission)
+        self.silent_powers = None
 
     def forward(self, normalize=False, **emission_evi):
         '''Runs the HMM forward by one iteration.'''
 
+        # steps without evidence on the emission are a product with a cached matrix
+        single_state = len(self.state.domain) == 1 and len(self.transition.domain) == 2
+        if single_state and not any(var in self.emission.domain for var in emission_evi):
+            return self.forward_silent(1, normalize)
+
         # get state vars (to be marginalized later)
         state_vars = self.state.domain
 
@@ -69,102 +149,303 @@ class HiddenMarkovModel():
 
         return self.state
 
+    def forward_silent(self, k=1, normalize=False):
+        '''
+        Runs the HMM forward by `k` steps without any evidence, at once. Such a step is the
+        transition followed by the emission with every evidence variable summed out, i.e. the fixed
+        matrix M = T diag(m), so `k` steps are a single product with the memoized power M^k.
+        For simplicity, we assume that there is only one state variable.
+        '''
+        matrix, log_scale = self._silent_powers().power(k)
+        state = self.state.table
+        if self.log_space:
+            with np.errstate(divide='ignore'):
+                table = logsumexp(state[:, np.newaxis] + np.log(matrix), axis=0) + log_scale
+        elif normalize:
+            # the scale cancels out, and could underflow over many steps
+            table = state @ matrix
+        else:
+            table = (state @ matrix) * np.exp(log_scale)
+        self._set_state(table)
+
+        if normalize:
+            self.state = self.state.normalize()
+
+        return self.state
+
+    def _silent_powers(self) -> MatrixPowers:
+        '''
+        Returns the memoized powers of the evidence-free step matrix, which are built on first use
+        after set_factors.
+        '''
+        if self.silent_powers is None:
+            transition = self._transition_matrix()
+            if self.log_space:
+                transition = np.exp(transition)
+            silent_likelihood = self.emission_matrix(1)[0]
+            self.silent_powers = MatrixPowers(transition * silent_likelihood)
+
+        return self.silent_powers
+
     def forward_batch(self, n, **emission_evi):
         '''
+        Runs the HMM forward over `n` steps at once, and returns a (steps x states) array of
+        filtered posteriors together with the log likelihood of the evidence.
         emission_evi: A dictionary of lists, each list containing the evidence list for a variable. 
                             Use `None` if no evidence for that timestep
         '''
-        history = []
-        for i in range(n):
-            # select evidence for this timestep
-            evi_dict = {
-                key: value[i]
-                for key, value in emission_evi.items()
-                if value[i] is not None }
+        return self.forward_filter(self.emission_matrix(n, **emission_evi))
 
-            # take a step forward
-            state = self.forward(**evi_dict)
-            history.append(state)
-        return history
-
-    def viterbi(self, **emission_evi):
+    def forward_filter(self, likelihoods: np.ndarray) -> tuple[np.ndarray, float]:
         '''
-        This function is very similar to the forward algorithm. 
-        For simplicity, we will assume that there is only one state variable, and one emission
-        variable.
+        Runs a scaled forward recursion from the current state over a (steps x states) array of
+        emission likelihoods. Each step is normalized, and the log of the normalizing constants adds
+        up to the log likelihood of the evidence. Returns the (steps x states) filtered posteriors
+        and the log likelihood. For simplicity, we assume that there is only one state variable.
         '''
+        n, num_states = likelihoods.shape
+        transition = self._transition_matrix()
+        state = self.state.table
+        if self.log_space:
+            transition = np.exp(transition)
+            state = np.exp(state - np.max(state))
+        state = state / np.sum(state)
+
+        posteriors = np.empty((n, num_states))
+        scales = np.empty(n)
+        for t in range(n):
+            state = (state @ transition) * likelihoods[t]
+            scales[t] = np.sum(state)
+            state = state / scales[t]
+            posteriors[t] = state
+
+        self._set_state(np.log(state) if self.log_space else state)
 
-        # confirm that state and emission each have 1 variable
+        with np.errstate(divide='ignore'):
+            return posteriors, float(np.sum(np.log(scales)))
+
+    def _state_var(self):
+        '''
+        Returns the name of the (single) state variable, and the name it takes after transition.
+        '''
         assert len(self.state.domain) == 1
-        assert len(self.emission.domain) == 2
         assert len(self.transition.domain) == 2
 
-        # get state and evidence var names (to be marginalized and maximised out later)
-        state_var_name = self.state.domain[0]
-        emission_vars = [v for v in self.emission.domain if v not in self.state.domain]
-        emission_var_name = emission_vars[0]
+        state_var = self.state.domain[0]
+        next_var = [var for var in self.transition.domain if var != state_var][0]
+        return state_var, next_var
 
-        # join with transition factor
-        f = self.state*self.transition
+    def _set_state(self, table: np.ndarray) -> None:
+        '''Replaces the state with a factor of the same kind over the given table.'''
+        state_var, _ = self._state_var()
+        self.state = self.state.__class__((state_var,), self.state.outcome_space, table=table)
 
-        # maximize out old state vars, leaving only new state vars
-        f, prev = f.maximize(state_var_name, return_prev=True)
-        self.prev_history.append(prev)
+    def _transition_matrix(self) -> np.ndarray:
+        '''Returns the transition table as a (states x next states) array.'''
+        state_var, next_var = self._state_var()
+        f = self.transition
+        return np.transpose(f.table, (f.domain.index(state_var), f.domain.index(next_var)))
 
-        # remap variables to their original names
-        f.domain = tuple(self.remap[var] for var in f.domain)
-        self.state = f
+    def emission_matrix(self, n, log=False, **emission_evi) -> np.ndarray:
+        '''
+        Turns the evidence of `n` steps into a (steps x states) array of emission likelihoods, i.e.
+        the emission factor with the evidence of each step set and every other variable summed out.
+        Each distinct evidence combination is only computed once.
+        emission_evi: A dictionary of lists, each list containing the evidence list for a variable. 
+                            Use `None` if no evidence for that timestep
+        log: return log likelihoods instead.
+        '''
+        state_var, _ = self._state_var()
+        likelihoods = np.empty((n, len(self.state.outcome_space[state_var])))
+        cache = {}
+        for i in range(n):
+            evi_dict = {
+                key: value[i]
+                for key, value in emission_evi.items()
+                if value[i] is not None }
 
-        # set emission evidence
-        emission_factor = self.emission.evidence(**emission_evi)
+            key = tuple(sorted(evi_dict.items()))
+            if key not in cache:
+                f = self.emission.evidence(**evi_dict)
+                for var in f.domain:
+                    if var != state_var:
+                        f = f.marginalize(var)
+                cache[key] = f.table
+            likelihoods[i] = cache[key]
 
-        # join with state factor
-        f = self.state * emission_factor
+        # convert between log and probability space if needed
+        if self.log_space and not log:
+            return np.exp(likelihoods)
+        if log and not self.log_space:
+            with np.errstate(divide='ignore'):
+                return np.log(likelihoods)
+        return likelihoods
 
-        # marginalize out emission var if it is in the factor domain
-        if emission_var_name in f.domain:
-            f = f.marginalize(emission_var_name)
+    def viterbi_decode(self, log_likelihoods: np.ndarray) -> list:
+        '''
+        Runs viterbi from the current state over a (steps x states) array of emission log
+        likelihoods, and returns the most likely sequence of states.
+        The recursion runs in log space on preallocated score and backpointer arrays; each step is
+        vectorized over the states. For simplicity, we assume that there is only one state variable.
+        '''
+        state_var, _ = self._state_var()
+        n, num_states = log_likelihoods.shape
 
-        # normalize state (keep commented out for now)
-        # self.state = self.state.normalize()
+        if self.log_space:
+            log_transition = self._transition_matrix()
+            score = self.state.table
+        else:
+            with np.errstate(divide='ignore'):
+                log_transition = np.log(self._transition_matrix())
+                score = np.log(self.state.table)
 
-        self.state = f
-        self.history.append(self.state)
-        return self.state
+        self.scores = np.empty((n, num_states))
+        self.backpointers = np.empty((n, num_states), dtype=np.intp)
+        states = np.arange(num_states)
+        for t in range(n):
+            # candidates[i, j]: best score of reaching state j at step t from state i at step t-1
+            candidates = score[:, np.newaxis] + log_transition
+            self.backpointers[t] = np.argmax(candidates, axis=0)
+            score = candidates[self.backpointers[t], states] + log_likelihoods[t]
+            self.scores[t] = score
+
+        # keep the final scores as the state, like the forward algorithm does
+        self._set_state(score if self.log_space else np.exp(score))
+
+        return self.trace_back()
 
     def viterbi_batch(self, n,  **emission_evi):
         '''
+        Runs viterbi over `n` steps and returns the most likely sequence of states.
         emission_evi: A dictionary of lists, each list containing the evidence list for a variable. 
                          Use `None` if no evidence for that timestep
         '''
-        for i in range(n):
-            # select evidence for this timestep
-            evi_dict = {
-                key: value[i]
-                for key, value in emission_evi.items()
-                if value[i] is not None }
-            self.viterbi(**evi_dict)
-        return self.history
+        return self.viterbi_decode(self.emission_matrix(n, log=True, **emission_evi))
 
     def trace_back(self):
         '''
-        This function iterates backwards over the history to find the most 
+        This function iterates backwards over the backpointers to find the most 
         likely sequence of states.
         For simplicity, this function assumes there is one state variable
         '''
-        # get most likely outcome of final state
-        index = np.argmax(self.history[-1].table)
+        n = len(self.scores)
+        index_list = np.empty(n, dtype=np.intp)
 
-        # Go through "prev_history" in reverse
-        index_list = []
-        for prev in reversed(self.prev_history):
-            index_list.append(index)
-            index = prev[index]
-        index_list = reversed(index_list)
+        # get most likely outcome of final state, then follow the backpointers in reverse
+        index_list[-1] = np.argmax(self.scores[-1])
+        for t in range(n - 1, 0, -1):
+            index_list[t - 1] = self.backpointers[t, index_list[t]]
 
         # translate the indicies into the outcomes they represent
-        mle_list = []
-        state_var = self.state.domain[0]
-        for idx in index_list:
-            mle_list.append(self.state.outcome_space[state_var][idx])
-        return mle_list
+        state_var, _ = self._state_var()
+        outcomes = self.state.outcome_space[state_var]
+        return [outcomes[idx] for idx in index_list]
+
+class BatchedHiddenMarkovModel():
+    '''
+    Helper class that runs many single-variable HMMs in lockstep, e.g. one per room.
+    All models must have the same number of states.
+    '''
+
+    def __init__(
+            self,
+            start_states: np.ndarray,
+            transitions: np.ndarray,
+            silent_likelihoods: np.ndarray = None):
+        '''
+        Takes 3 arguments:
+        - start_states: a (models x states) array, one start state distribution per row.
+        - transitions: a (models x states x states) array, where transitions[m, i, j] is the
+            transition prob from state i to state j in model m.
+        - silent_likelihoods: a (models x states) array with the emission likelihoods of a step
+            without any evidence. Only needed by forward_silent.
+        '''
+        self.states = np.array(start_states, dtype=np.float64)
+        self.transitions = np.asarray(transitions, dtype=np.float64)
+        self.silent_likelihoods = None
+        if silent_likelihoods is not None:
+            self.silent_likelihoods = np.array(silent_likelihoods, dtype=np.float64)
+
+        # memoized powers of the evidence-free step of every model
+        self.silent_powers = None
+
+    def forward(self, likelihoods: np.ndarray, normalize=False) -> np.ndarray:
+        '''
+        Runs every HMM forward by one iteration.
+        likelihoods: a (models x states) array with the emission likelihood of each state.
+        '''
+        # push every state through its own transition matrix: (m x 1 x s) @ (m x s x s)
+        states = np.matmul(self.states[:, np.newaxis, :], self.transitions)[:, 0, :]
+        states *= likelihoods
+        if normalize:
+            states /= states.sum(axis=1, keepdims=True)
+
+        self.states = states
+        return self.states
+
+    def forward_silent(self, k=1, normalize=False) -> np.ndarray:
+        '''
+        Runs every HMM forward by `k` steps without any evidence, at once. Each model's step is the
+        fixed matrix T diag(silent likelihoods), so `k` steps are a single product with its memoized
+        k-th power.
+        '''
+        if self.silent_powers is None:
+            self.silent_powers = MatrixPowers(
+                self.transitions * self.silent_likelihoods[:, np.newaxis, :])
+        matrices, log_scales = self.silent_powers.power(k)
+
+        states = np.matmul(self.states[:, np.newaxis, :], matrices)[:, 0, :]
+        if normalize:
+            states /= states.sum(axis=1, keepdims=True)
+        else:
+            states *= np.exp(log_scales)[:, np.newaxis]
+
+        self.states = states
+        return self.states
+
+    def smooth(self, likelihoods: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        Runs a scaled forward-backward pass for every model from the current states, without
+        changing them. Returns the smoothed posteriors P(state_t | all evidence) as a
+        (steps x models x states) array, and the log likelihood of each model's evidence.
+        likelihoods: a (steps x models x states) array of emission likelihoods.
+        '''
+        n, num_models, num_states = likelihoods.shape
+        alphas = np.empty((n, num_models, num_states))
+        scales = np.empty((n, num_models, 1))
+
+        # forward pass: alphas[t] = P(state_t | evidence up to t)
+        state = self.states / self.states.sum(axis=1, keepdims=True)
+        for t in range(n):
+            state = np.matmul(state[:, np.newaxis, :], self.transitions)[:, 0, :] * likelihoods[t]
+            scales[t] = state.sum(axis=1, keepdims=True)
+            state = state / scales[t]
+            alphas[t] = state
+
+        # backward pass, reusing the forward scales: beta_t = T @ (L_t+1 * beta_t+1) / c_t+1
+        smoothed = np.empty_like(alphas)
+        beta = np.ones((num_models, num_states))
+        smoothed[-1] = alphas[-1]
+        for t in range(n - 2, -1, -1):
+            message = likelihoods[t + 1] * beta
+            beta = np.matmul(self.transitions, message[:, :, np.newaxis])[:, :, 0] / scales[t + 1]
+            smoothed[t] = alphas[t] * beta
+        smoothed /= smoothed.sum(axis=2, keepdims=True)
+
+        with np.errstate(divide='ignore'):
+            log_likelihoods = np.sum(np.log(scales[:, :, 0]), axis=0)
+        return smoothed, log_likelihoods
+
+    def set_state(self, model: int, state: np.ndarray) -> None:
+        '''Overwrites the state distribution of a single model.'''
+        self.states[model] = state
+
+    def set_model(self, model: int, transition: np.ndarray, silent_likelihood=None) -> None:
+        '''
+        Replaces the transition matrix of a single model (and its silent likelihoods, if given),
+        e.g. after its parameters were updated.
+        '''
+        self.transitions[model] = transition
+        if silent_likelihood is not None:
+            self.silent_likelihoods[model] = silent_likelihood
+        self.silent_powers = None
@@ -0,0 +1,207 @@
+'''
+    Helper class that compiles a BayesNet into a junction tree.
+'''
+
+import numpy as np
+
+from MF_DiscreteFactors import Factor
+from MF_Graph import Graph
+
+class JunctionTree:
+    '''
+    Helper class that answers many queries on one BayesNet. The network is compiled once into a
+    tree of cliques (the triangulated interaction graph), and calibrated by two-pass message
+    passing, after which every single-variable posterior comes from its clique's belief.
+
+    Evidence is entered as indicator factors on the clique of each observed variable. Only the
+    messages leaving the changed cliques are recomputed, so new evidence is re-propagated
+    incrementally instead of calibrating the whole tree again.
+    '''
+
+    def __init__(self, bn, order=None) -> None:
+        '''
+        bn: the BayesNet to compile. Later changes to its factors require compiling it again.
+        order: the elimination order used to triangulate (by default, bn.cheapestOrder()).
+        '''
+        self.outcome_space = bn.outcome_space
+        if order is None:
+            order = bn.cheapestOrder()
+        self.cliques = self.triangulate(bn.interactionGraph(), order)
+
+        # each variable is read from (and observed in) the smallest clique that contains it
+        self.var_clique = {}
+        by_size = sorted(range(len(self.cliques)), key=lambda i: len(self.cliques[i]), reverse=True)
+        for i in by_size:
+            for var in self.cliques[i]:
+                self.var_clique[var] = i
+
+        self.build_tree()
+
+        # every factor is assigned to a clique that covers its domain
+        self.base_potentials = [
+            Factor(clique, self.outcome_space, trivial=True) for clique in self.cliques ]
+        for factor in bn.factors.values():
+            i = min(
+                (i for i, clique in enumerate(self.cliques) if set(factor.domain) <= set(clique)),
+                key=lambda i: len(self.cliques[i]))
+            self.base_potentials[i] = self.base_potentials[i] * factor
+
+        self.evidence = {}
+        self.potentials = list(self.base_potentials)
+        self.messages = {}
+        self.beliefs = {}
+
+        # cliques whose potential changed since the last calibration (all of them, at first)
+        self.changed = set(range(len(self.cliques)))
+
+    @staticmethod
+    def triangulate(ig: Graph, order: list) -> list[tuple]:
+        '''
+        Eliminates the variables of an interaction graph in `order`, and returns the maximal
+        cliques of the triangulated graph. The graph is modified.
+        '''
+        cliques = []
+        for var in order:
+            neighbours = list(ig.children(var))
+            # connect the neighbours of var, like minDegree does
+            for n, var1 in enumerate(neighbours):
+                for var2 in neighbours[n+1:]:
+                    if var1 not in ig.children(var2):
+                        ig.add_edge(var1, var2, directed=False)
+            cliques.append(tuple([var] + neighbours))
+            ig.remove_node(var)
+
+        # drop the cliques contained in another one
+        return [
+            clique for n, clique in enumerate(cliques)
+            if not any(
+                set(clique) <= set(other) and (len(clique) < len(other) or m < n)
+                for m, other in enumerate(cliques) if m != n) ]
+
+    def build_tree(self) -> None:
+        '''
+        Connects the cliques into a tree with Graph.prim. The clique graph links every pair of
+        cliques, weighted by the negated size of their separator, so the minimum spanning tree
+        maximizes the separators (which makes it a junction tree).
+        '''
+        clique_graph = Graph()
+        clique_graph.add_node(0)
+        for i, clique1 in enumerate(self.cliques):
+            for j in range(i + 1, len(self.cliques)):
+                separator = set(clique1) & set(self.cliques[j])
+                clique_graph.add_edge(i, j, weight=-len(separator), directed=False)
+
+        tree = clique_graph.prim(0)
+        tree.add_node(0)
+        self.root = 0
+        self.tree_children = tree.adj_list
+        self.parent = { child: i for i, children in tree.adj_list.items() for child in children }
+
+        # parents come before their children
+        self.preorder = [self.root]
+        for i in self.preorder:
+            self.preorder.extend(self.tree_children.get(i, []))
+
+        self.separators = {}
+        for child, i in self.parent.items():
+            separator = tuple(var for var in self.cliques[child] if var in self.cliques[i])
+            self.separators[(child, i)] = self.separators[(i, child)] = separator
+
+    def neighbours(self, i: int) -> list[int]:
+        '''Returns the cliques adjacent to clique i in the tree.'''
+        neighbours = list(self.tree_children.get(i, []))
+        if i in self.parent:
+            neighbours.append(self.parent[i])
+        return neighbours
+
+    def set_evidence(self, **evidence) -> None:
+        '''
+        Observes variables (retracting them when their value is None). Only the cliques of the
+        variables whose value changed are re-propagated by the next calibration.
+        '''
+        for var, value in evidence.items():
+            if self.evidence.get(var) == value:
+                continue
+            if value is None:
+                del self.evidence[var]
+            else:
+                self.evidence[var] = value
+            self.changed.add(self.var_clique[var])
+
+    def clear_evidence(self) -> None:
+        '''Retracts every observation.'''
+        self.set_evidence(**{ var: None for var in self.evidence })
+
+    def calibrate(self) -> None:
+        '''
+        Recomputes the messages affected by the changed cliques: the upward message of a clique is
+        stale when a changed clique is below it, and the downward message to a clique is stale when
+        a changed clique is outside its subtree.
+        '''
+        if not self.changed:
+            return
+
+        for i in self.changed:
+            self.potentials[i] = self.base_potentials[i]
+            for var, value in self.evidence.items():
+                if self.var_clique[var] == i:
+                    self.potentials[i] = self.potentials[i] * self.indicator(var, value)
+
+        # number of changed cliques in the subtree of every clique
+        changed_below = { i: int(i in self.changed) for i in self.preorder }
+        for i in reversed(self.preorder[1:]):
+            changed_below[self.parent[i]] += changed_below[i]
+
+        # collect (leaves to root), then distribute (root to leaves)
+        for i in reversed(self.preorder[1:]):
+            if changed_below[i] > 0:
+                self.messages[(i, self.parent[i])] = self.message(i, self.parent[i])
+        for i in self.preorder[1:]:
+            if changed_below[i] < len(self.changed):
+                self.messages[(self.parent[i], i)] = self.message(self.parent[i], i)
+
+        self.changed.clear()
+        self.beliefs.clear()
+
+    def indicator(self, var: str, value) -> Factor:
+        '''Returns the factor over var that is 1 for the observed value, and 0 otherwise.'''
+        outcomes = self.outcome_space[var]
+        table = np.zeros(len(outcomes))
+        table[outcomes.index(value)] = 1
+        return Factor((var,), self.outcome_space, table=table)
+
+    def message(self, i: int, j: int) -> Factor:
+        '''Returns the (normalized) message sent by clique i to clique j.'''
+        factor = self.potentials[i]
+        for k in self.neighbours(i):
+            if k != j:
+                factor = factor * self.messages[(k, i)]
+        for var in factor.domain:
+            if var not in self.separators[(i, j)]:
+                factor = factor.marginalize(var)
+        return factor.normalize()
+
+    def belief(self, i: int) -> Factor:
+        '''Returns the (unnormalized) belief of clique i, calibrating the tree first.'''
+        self.calibrate()
+        if i not in self.beliefs:
+            factor = self.potentials[i]
+            for k in self.neighbours(i):
+                factor = factor * self.messages[(k, i)]
+            self.beliefs[i] = factor
+        return self.beliefs[i]
+
+    def marginal(self, var: str) -> Factor:
+        '''Returns P(var | evidence).'''
+        factor = self.belief(self.var_clique[var])
+        for other in factor.domain:
+            if other != var:
+                factor = factor.marginalize(other)
+        # a new factor, since the belief itself may be the marginal
+        return Factor((var,), self.outcome_space, table=factor.table / np.sum(factor.table))
+
+    def marginals(self, variables=None) -> dict[str, Factor]:
+        '''Returns P(var | evidence) for every variable (or for the given ones).'''
+        if variables is None:
+            variables = self.var_clique.keys()
+        return { var: self.marginal(var) for var in variables }
@@ -0,0 +1,59 @@
+'''
+    Helper class to store a bounded cache with least recently used eviction.
+'''
+
+import threading
+from collections import OrderedDict
+
+class LRUCache:
+    '''
+    Helper class that maps keys to values, keeping at most `maxsize` entries. Once full, adding an
+    entry evicts the one that was least recently used. Safe to share between threads.
+    '''
+
+    def __init__(self, maxsize=1024) -> None:
+        if maxsize < 1:
+            raise ValueError('maxsize must be at least 1')
+
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, key) -> bool:
+        return key in self.entries
+
+    def get(self, key, default=None):
+        '''Returns the value of `key` (marking it as recently used), or `default` if absent.'''
+        with self.lock:
+            try:
+                value = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value) -> None:
+        '''Adds or replaces the value of `key`, evicting the least recently used entry if full.'''
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        '''Removes `key`, and returns its value or `default` if absent.'''
+        with self.lock:
+            return self.entries.pop(key, default)
+
+    def clear(self) -> None:
+        '''Removes every entry.'''
+        with self.lock:
+            self.entries.clear()
@@ -0,0 +1,209 @@
+'''
+    Helper file to save trained RoomPredictors to disk, and load them back.
+
+    The cache is a single .npz file holding the tables of the learned factors, so that loading does
+    not learn them again, and the counts they were learned from, so that loaded predictors can
+    still learn online. A JSON string holds the metadata needed to rebuild the predictors (outcome
+    spaces, sensors, factor domains).
+
+    Cache files are named after a key that hashes everything the trained predictors depend on: the
+    training files, the model configuration, the training hyperparameters and the source of the
+    training code. A stale cache is therefore never loaded, and is deleted when a new one is saved.
+'''
+
+import glob
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+import MF_RoomPredictor
+import MF_Utils as Utils
+from MF_DiscreteFactors import Factor, SparseFactor
+from MF_RoomPredictor import RoomPredictor
+
+CACHE_PREFIX = 'model_cache_'
+
+# The modules whose code decides what is trained (and how it is saved)
+TRAINING_MODULES = (
+    'MF_DiscreteFactors',
+    'MF_EncodedDataset',
+    'MF_ModelCache',
+    'MF_RoomPredictor',
+    'MF_StreamingTrainer',
+    'MF_Utils',
+)
+
+def hyperparameters() -> dict:
+    '''Returns the current training hyperparameters (which may differ from the source defaults).'''
+    return {
+        'emission_alpha': MF_RoomPredictor.EMISSION_ALPHA,
+        'max_dense_emission_cells': MF_RoomPredictor.MAX_DENSE_EMISSION_CELLS,
+        'people_count_edges': list(Utils.PEOPLE_COUNT_EDGES),
+        'people_count_buckets': list(Utils.PEOPLE_COUNT_BUCKETS),
+        'time_buckets': list(Utils.TIME_BUCKETS),
+    }
+
+def cache_key(filenames: list[str], config) -> str:
+    '''
+    Returns a content hash of the training files, of the model configuration (which must be
+    JSON serializable, e.g. the room_evidences dictionary), of the hyperparameters and of the
+    source of the TRAINING_MODULES.
+    '''
+    digest = hashlib.sha256()
+    for filename in filenames:
+        with open(filename, 'rb') as file:
+            digest.update(hashlib.sha256(file.read()).digest())
+    digest.update(json.dumps(config, sort_keys=True).encode())
+    digest.update(json.dumps(hyperparameters(), sort_keys=True).encode())
+
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for module in TRAINING_MODULES:
+        with open(os.path.join(directory, module + '.py'), 'rb') as file:
+            digest.update(hashlib.sha256(file.read()).digest())
+    return digest.hexdigest()
+
+def cache_path(directory: str, key: str) -> str:
+    '''Returns the path of the cache file of `key` in `directory`.'''
+    return os.path.join(directory, f'{CACHE_PREFIX}{key[:16]}.npz')
+
+def load_or_train(directory: str, key: str, train) -> dict[str, RoomPredictor]:
+    '''
+    Loads the predictors cached under `key` in `directory`. On a miss, they are trained with
+    `train()` and cached, replacing the superseded cache files. A folder that cannot be written to
+    (e.g. read-only) only means that the trained predictors are not cached.
+    '''
+    path = cache_path(directory, key)
+    if os.path.exists(path):
+        return load_predictors(path)
+
+    predictors = train()
+    try:
+        save_predictors(path, predictors)
+        remove_superseded(path)
+    except OSError:
+        pass
+    return predictors
+
+def remove_superseded(path: str) -> None:
+    '''Deletes every other cache file in the folder of `path`.'''
+    pattern = os.path.join(os.path.dirname(os.path.abspath(path)), f'{CACHE_PREFIX}*.npz')
+    for other in glob.glob(pattern):
+        if not os.path.samefile(other, path):
+            os.remove(other)
+
+def _pack(room_arrays: dict[str, dict[str, np.ndarray]]) -> tuple[dict[str, np.ndarray], dict]:
+    '''
+    Packs the arrays of every room into one flat array per array name and dtype, since every array
+    of an .npz file costs about 0.1 ms to load. Returns the packed arrays, and the layout of each
+    room (the packed array, offset and shape of each of its arrays) to unpack them with.
+    '''
+    parts = {}
+    sizes = {}
+    layout = {}
+    for room, arrays in room_arrays.items():
+        layout[room] = {}
+        for name, array in arrays.items():
+            array = np.asarray(array)
+            packed = f'{name}.{array.dtype.name}'
+            parts.setdefault(packed, []).append(array.ravel())
+            offset = sizes.get(packed, 0)
+            sizes[packed] = offset + array.size
+            layout[room][name] = [packed, offset, list(array.shape)]
+
+    return { packed: np.concatenate(arrays) for packed, arrays in parts.items() }, layout
+
+def _unpack(packed_arrays: dict[str, np.ndarray], room_layout: dict) -> dict[str, np.ndarray]:
+    '''Returns the arrays of a room from the packed arrays (as views), see `_pack`.'''
+    return {
+        name: packed_arrays[packed][offset:offset + int(np.prod(shape))].reshape(shape)
+        for name, (packed, offset, shape) in room_layout.items() }
+
+def save_predictors(path: str, predictors: dict[str, RoomPredictor]) -> None:
+    '''
+    Saves the factors and counts of every predictor to `path`. The file is written to a temporary
+    file first and then moved into place, so readers never see a partial cache.
+    '''
+    room_arrays = {}
+    metadata = {}
+    for room, predictor in predictors.items():
+        if predictor.emission_counts is None:
+            raise ValueError(f'Room {room} has no counts to save')
+
+        emission_factor = predictor.emission_factor
+        metadata[room] = {
+            'sensors': list(predictor.sensors),
+            'outcome_space': {
+                var: list(outcomes) for var, outcomes in predictor.outcome_space.items() },
+            'num_emission_counts': len(predictor.emission_counts),
+        }
+
+        arrays = {
+            'state_counts': predictor.state_counts,
+            'transition_counts': predictor.transition_counts,
+            'state_table': predictor.state_factor.table,
+            'transition_table': predictor.transition_factor.table,
+        }
+        for i, counts in enumerate(predictor.emission_counts):
+            arrays[f'emission_counts_{i}'] = counts
+        if isinstance(emission_factor, SparseFactor):
+            metadata[room]['emission_domain'] = [
+                list(emission_factor.sparse_domain), list(emission_factor.dense_domain)]
+            arrays['emission_keys'] = emission_factor.keys
+            arrays['emission_values'] = emission_factor.values
+            arrays['emission_default'] = emission_factor.default
+        else:
+            metadata[room]['emission_domain'] = list(emission_factor.domain)
+            arrays['emission_table'] = emission_factor.table
+        room_arrays[room] = arrays
+
+    packed_arrays, layout = _pack(room_arrays)
+    for room, room_layout in layout.items():
+        metadata[room]['arrays'] = room_layout
+    packed_arrays['metadata'] = np.array(json.dumps(metadata))
+
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(dir=directory, suffix='.npz', delete=False) as file:
+        np.savez(file, **packed_arrays)
+    os.chmod(file.name, 0o644)
+    os.replace(file.name, path)
+
+def load_predictors(path: str) -> dict[str, RoomPredictor]:
+    '''Loads predictors saved by `save_predictors`, with their factors and counts.'''
+    with np.load(path, allow_pickle=False) as npz:
+        packed_arrays = { name: npz[name] for name in npz.files }
+    metadata = json.loads(str(packed_arrays.pop('metadata')))
+
+    predictors = {}
+    for room, room_metadata in metadata.items():
+        outcome_space = {
+            var: tuple(outcomes) for var, outcomes in room_metadata['outcome_space'].items() }
+        arrays = _unpack(packed_arrays, room_metadata['arrays'])
+        emission_counts = [
+            arrays[f'emission_counts_{i}'] for i in range(room_metadata['num_emission_counts']) ]
+
+        emission_domain = room_metadata['emission_domain']
+        if 'emission_keys' in arrays:
+            emission_factor = SparseFactor(
+                emission_domain[0],
+                emission_domain[1],
+                outcome_space,
+                arrays['emission_keys'],
+                arrays['emission_values'],
+                arrays['emission_default'])
+        else:
+            emission_factor = Factor(
+                tuple(emission_domain), outcome_space, table=arrays['emission_table'])
+
+        predictors[room] = RoomPredictor.from_factors(
+            room,
+            room_metadata['sensors'],
+            outcome_space,
+            Factor((room,), outcome_space, table=arrays['state_table']),
+            Factor((room, room + '_next'), outcome_space, table=arrays['transition_table']),
+            emission_factor,
+            counts=(arrays['state_counts'], arrays['transition_counts'], emission_counts))
+
+    return predictors
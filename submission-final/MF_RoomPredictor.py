@@ -2,45 +2,195 @@
     Helper class that defines RoomPredictor objects.
 '''
 
-from itertools import permutations
+from multiprocessing import Pool, resource_tracker, util
 
+import numpy as np
 import pandas as pd
 import MF_Utils as Utils
-from MF_DiscreteFactors import Factor
+from MF_DiscreteFactors import Factor, SparseFactor, outcome_index
+from MF_EncodedDataset import EncodedDataset
 from MF_HiddenMarkovModel import HiddenMarkovModel
+from MF_LRUCache import LRUCache
+
+# Emission tables larger than this (in cells) are stored as sparse factors
+MAX_DENSE_EMISSION_CELLS = 2 ** 20
+
+# Number of evidence codes of a sparse emission factor, not seen in training, kept once looked up
+EMISSION_CACHE_SIZE = 4096
+
+# Additive smoothing (pseudo counts per cell) of the learned emission factors
+EMISSION_ALPHA = 2
+
+def decide_light(prediction: str, empty_prob: float, threshold=None) -> str:
+    '''
+    Decides whether a room's light should be on. With a threshold, the light is only turned off
+    once the room is empty with at least that probability, otherwise it follows the prediction.
+    '''
+    if threshold is not None:
+        return 'off' if empty_prob >= threshold else 'on'
+    return 'off' if prediction == '0' else 'on'
+
+def sparse_emissions(outcome_space: dict[str, tuple], room: str, sensors: list[str]) -> bool:
+    '''
+    Whether the emission factor of a room is stored sparsely. Rooms with many neighbours (e.g. c2)
+    have far too many parent configurations, almost all of which are never seen.
+    '''
+    num_cells = 1
+    for var in [room] + sensors:
+        num_cells *= len(outcome_space[var])
+    return num_cells > MAX_DENSE_EMISSION_CELLS and bool(sensors)
+
+def count_states(codes: np.ndarray, num_outcomes: int) -> np.ndarray:
+    '''Counts each outcome of a room's codes (missing values are not counted).'''
+    return np.bincount(codes[codes >= 0], minlength=num_outcomes)
+
+def count_transitions(codes: np.ndarray, num_outcomes: int, same_day: np.ndarray) -> np.ndarray:
+    '''
+    Counts each transition (t, t+1) of a room's codes, over the full grid of outcomes. Only pairs
+    marked in `same_day` (see EncodedDataset.same_day_pairs) with both values known are counted.
+    '''
+    room_t0 = codes[:-1].astype(np.intp)
+    room_t1 = codes[1:].astype(np.intp)
+    valid = same_day & (room_t0 >= 0) & (room_t1 >= 0)
+
+    # Count all transitions at once with a 2-D bincount over (t0, t1) codes
+    counts = np.bincount(
+        room_t0[valid] * num_outcomes + room_t1[valid], minlength=num_outcomes * num_outcomes)
+    return counts.reshape(num_outcomes, num_outcomes)
+
+def count_emissions(
+        data: EncodedDataset,
+        room: str,
+        sensors: list[str],
+        outcome_space: dict[str, tuple]) -> tuple:
+    '''Counts the sufficient statistics of a room's emission factor, dense or sparse.'''
+    if sparse_emissions(outcome_space, room, sensors):
+        return Utils.count_sparse_factor(data, room, sensors, outcome_space)
+    return Utils.count_factor(data, room, sensors, outcome_space)
 
 class RoomPredictor:
     '''Helper class to make predictions for each room.'''
 
     def __init__(
             self,
-            data: pd.DataFrame,
+            data: pd.DataFrame | EncodedDataset,
             room: str,
             sensors: list[str],
             outcomes_remap: dict[str, tuple] = None) -> None:
+        '''
+        Trains the predictor of `room` from `data`. An EncodedDataset is read in place (and can be
+        shared by every predictor), a DataFrame is encoded first using `outcomes_remap`.
+        '''
         # Setup training data
         self.room = room
         self.sensors = sensors
         self.vars = [room] + sensors
-        self.training_data = data[self.vars]
+        if not isinstance(data, EncodedDataset):
+            data = EncodedDataset(data, outcomes_remap, columns=self.vars)
+        self.training_data = data
 
         # Setup outcome space
         self.outcome_space = self.learn_outcome_space()
-        if outcomes_remap is not None:
-            self.outcome_space.update(
-                {k: v for k, v in outcomes_remap.items() if k in self.outcome_space})
-
         self.outcome_space[self.room + '_next'] = self.outcome_space[self.room]
 
-        # Setup prediction factors
-        self.state_factor = self.learn_states()
-        self.transition_factor = self.learn_transitions()
-        self.emission_factor = self.learn_emissions()
+        # Setup prediction factors, keeping their counts for online updates
+        self.set_counts(*self.learn_counts())
+        self.setup_model()
+
+    @classmethod
+    def from_factors(
+            cls,
+            room: str,
+            sensors: list[str],
+            outcome_space: dict[str, tuple],
+            state_factor: Factor,
+            transition_factor: Factor,
+            emission_factor: Factor,
+            training_data: EncodedDataset = None,
+            counts: tuple = None):
+        '''
+        Creates a RoomPredictor from already learned factors (e.g. trained elsewhere or cached). The
+        training data is optional. The predictor can only learn online if it is given the counts the
+        factors were learned from, as (state counts, transition counts, emission counts).
+        '''
+        predictor = cls.__new__(cls)
+        predictor.room = room
+        predictor.sensors = sensors
+        predictor.vars = [room] + sensors
+        predictor.training_data = training_data
+        predictor.outcome_space = outcome_space
+
+        if counts is None:
+            predictor.state_counts = None
+            predictor.transition_counts = None
+            predictor.emission_counts = None
+        else:
+            predictor.store_counts(*counts)
+        predictor.state_factor = state_factor
+        predictor.transition_factor = transition_factor
+        predictor.emission_factor = emission_factor
+
+        predictor.setup_model()
+        return predictor
+
+    @classmethod
+    def from_counts(
+            cls,
+            room: str,
+            sensors: list[str],
+            outcome_space: dict[str, tuple],
+            state_counts: np.ndarray,
+            transition_counts: np.ndarray,
+            emission_counts: tuple,
+            training_data: EncodedDataset = None):
+        '''
+        Creates a RoomPredictor from the counts of `count_states`, `count_transitions` and
+        `count_emissions`, e.g. accumulated over many days by a StreamingTrainer, or loaded from a
+        cache. The counts are kept, so the predictor can learn online.
+        '''
+        predictor = cls.__new__(cls)
+        predictor.room = room
+        predictor.sensors = sensors
+        predictor.vars = [room] + sensors
+        predictor.training_data = training_data
+        predictor.outcome_space = outcome_space
+
+        predictor.set_counts(state_counts, transition_counts, emission_counts)
+        predictor.setup_model()
+        return predictor
+
+    def set_counts(self, state_counts, transition_counts, emission_counts: tuple) -> None:
+        '''Stores the counts of the room, and learns the factors from them.'''
+        self.store_counts(state_counts, transition_counts, emission_counts)
+
+        self.state_factor = self.states_from_counts(
+            self.room, self.outcome_space, self.state_counts)
+        self.transition_factor = self.transitions_from_counts(
+            self.room, self.outcome_space, self.transition_counts)
+        self.emission_factor = self.emissions_from_counts(
+            self.room, self.sensors, self.outcome_space, self.emission_counts)
+
+    def store_counts(self, state_counts, transition_counts, emission_counts: tuple) -> None:
+        '''Stores the counts of the room (as writeable arrays), leaving the factors unchanged.'''
+        self.state_counts = np.array(state_counts, dtype=np.float64)
+        self.transition_counts = np.array(transition_counts, dtype=np.float64)
+        self.emission_counts = [np.array(counts) for counts in emission_counts]
+
+        # online updates not yet applied to the factors (see observe)
+        self.stale = False
+        self.stale_rows = set()
+        self.new_emission_counts = {}
+
+    def setup_model(self) -> None:
+        '''Sets up the HMM and the emission lookup table from the learned factors.'''
         self.var_remap = { str(self.room + '_next'): self.room }
 
         self.hmm = HiddenMarkovModel(
             self.state_factor, self.transition_factor, self.emission_factor, self.var_remap)
 
+        # Setup emission lookup table
+        self.compile_emissions()
+
     def prediction(self, threshold=0.95, **evidence):
         '''
         Runs a prediction on the next transition. Has an additional side effect of changing internal
@@ -52,62 +202,380 @@ class RoomPredictor:
         # prediction is now not off or on, it's bins, so need to return both
         mle_index = prediction_factor.table.argmax()
         prediction = self.outcome_space[self.room][mle_index]
-        light = 'on'
-        if prediction == '0':
-            light = 'off'
 
-        if threshold is not None:
-            if prediction_factor['0'] >= threshold:
-                return prediction, 'off'
-            return prediction, 'on'
+        return prediction, decide_light(prediction, prediction_factor['0'], threshold)
 
-        return prediction, light
+    def observe(
+            self,
+            outcome: str,
+            previous_state: np.ndarray = None,
+            parent_codes: tuple[int] = None,
+            **evidence) -> None:
+        '''
+        Learns online from a ground-truth outcome of the room at the current tick (e.g. counted by a
+        robot), by adding it to the counts in O(1). The factors are only re-normalized by
+        `update_factors`, so many observations can be applied in one batch.
+        - previous_state: the belief over the room at the previous tick (one-hot if it was
+                observed). Its expected transition into `outcome` is counted. If None, no
+                transition is counted.
+        - evidence: the evidence of the current tick. Emissions are only counted when every sensor
+                of the room has a known value.
+        - parent_codes: the evidence as the outcome index of each sensor (-1 if unknown), in the
+                order of `self.sensors`, instead of `evidence`.
+        '''
+        if self.emission_counts is None:
+            raise ValueError(f'Room {self.room} has no counts to learn online from')
 
-    def learn_outcome_space(self) -> dict[str, tuple]:
-        '''Learns the outcome space for each variable in the training data.'''
-        outcome_space = {}
-        for column in list(self.training_data.columns):
-            values = list(self.training_data[column].unique())
-            outcome_space[column] = tuple(values)
+        room_code = outcome_index(self.outcome_space[self.room])[outcome]
+        self.state_counts[room_code] += 1
+        if previous_state is not None:
+            self.transition_counts[:, room_code] += previous_state
+        self.stale = True
 
-        return outcome_space
+        # parent configuration of the emission, if fully observed
+        if parent_codes is None:
+            parent_codes = tuple(
+                outcome_index(self.outcome_space[var]).get(evidence.get(var), -1)
+                for var in self.sensors)
+        parent_codes = tuple(int(code) for code in parent_codes)
+        if -1 in parent_codes:
+            return
 
-    def learn_states(self) -> Factor:
-        '''Learns the different states for the given room.'''
-        state_factor = Factor((self.room,), self.outcome_space)
-        probs = self.training_data[self.room].value_counts(normalize=True)
+        if sparse_emissions(self.outcome_space, self.room, self.sensors):
+            seen, parent_counts, counts = self.emission_counts
+            parent_shape = tuple(len(self.outcome_space[var]) for var in self.sensors)
+            flat_index = np.ravel_multi_index(parent_codes, parent_shape)
+            row = np.searchsorted(seen, flat_index)
+            if row < len(seen) and seen[row] == flat_index:
+                parent_counts[row, 0] += 1
+                counts[row, room_code] += 1
+            else:
+                # configurations never seen are merged in by update_factors
+                new_counts = self.new_emission_counts.setdefault(
+                    flat_index, np.zeros(counts.shape[1], dtype=counts.dtype))
+                new_counts[room_code] += 1
+        else:
+            counts, parent_counts = self.emission_counts
+            counts[parent_codes + (room_code,)] += 1
+            parent_counts[parent_codes + (0,) * (parent_counts.ndim - len(parent_codes))] += 1
+        self.stale_rows.add(parent_codes)
 
-        for outcome in self.outcome_space[self.room]:
-            state_factor[outcome] = probs[outcome] if outcome in probs.index else 0.0
+    def update_factors(self) -> None:
+        '''
+        Re-normalizes the factors affected by the observations since the last update, and recompiles
+        the emission lookup table. The state of the HMM is kept.
+        '''
+        if not self.stale:
+            return
+
+        self.state_factor = self.states_from_counts(
+            self.room, self.outcome_space, self.state_counts)
+        self.transition_factor = self.transitions_from_counts(
+            self.room, self.outcome_space, self.transition_counts)
 
-        return state_factor
+        if sparse_emissions(self.outcome_space, self.room, self.sensors):
+            if self.new_emission_counts:
+                new_seen = np.array(sorted(self.new_emission_counts), dtype=np.int64)
+                new_counts = np.stack([self.new_emission_counts[i] for i in new_seen.tolist()])
+                new_parent_counts = new_counts.sum(axis=1, keepdims=True)
+                self.emission_counts = list(Utils.merge_sparse_counts(
+                    self.emission_counts, (new_seen, new_parent_counts, new_counts)))
+            self.emission_factor = self.emissions_from_counts(
+                self.room, self.sensors, self.outcome_space, self.emission_counts)
+        else:
+            # only the observed rows change; every row of the table sums to the same constant
+            counts, parent_counts = self.emission_counts
+            num_outcomes = len(self.outcome_space[self.room])
+            for row in self.stale_rows:
+                probs = (counts[row] + EMISSION_ALPHA) / (
+                    parent_counts[row] + EMISSION_ALPHA * num_outcomes)
+                self.emission_factor.set_index(row, probs * self.emission_factor.table[row].sum())
 
-    def learn_transitions(self) -> Factor:
-        '''Learns the transition probabilities for the given room.'''
-        transition_domain = [self.room, self.room + '_next']
-        transition_factor = Factor(tuple(transition_domain), self.outcome_space)
+        self.stale = False
+        self.stale_rows = set()
+        self.new_emission_counts = {}
 
-        # Get original and transition column
-        room_t0 = self.training_data[self.room]
-        room_t1 = room_t0.shift(-1)
-        transition_table = pd.concat([room_t0, room_t1], axis=1)
-        transition_table.columns = transition_domain
+        # the dense emission table may have been updated in place
+        self.hmm.set_factors(self.transition_factor, self.emission_factor)
+        self.compile_emissions()
 
-        # Get probabilities
-        transition_probs = transition_table.value_counts(normalize=True)
+    def compile_emissions(self) -> None:
+        '''
+        Compiles the emission factor into a lookup table of room likelihoods, indexed by an integer
+        code of the evidence. Each evidence variable gets one extra outcome meaning "missing", whose
+        rows have that variable summed out, so every pattern of missing evidence is precomputed.
+
+        Sparse emission factors would need far too many rows, so their table is a dictionary holding
+        the configurations seen in training and the all-missing row. Other codes are computed when
+        looked up, and only the EMISSION_CACHE_SIZE most recent ones are kept.
+        '''
+        self.evidence_vars = tuple(v for v in self.emission_factor.domain if v != self.room)
+        self.evidence_codes = [outcome_index(self.outcome_space[var]) for var in self.evidence_vars]
 
-        # Copy over transition probabilities
-        for transition in permutations(Utils.PEOPLE_COUNT_BUCKETS, 2):
-            transition_exists = transition_probs.index.isin([transition]).any()
-            probability = transition_probs[transition] if transition_exists else 0.0
-            transition_factor[transition[0], transition[1]] = probability
+        # mixed radix over (outcomes + missing), last variable changing fastest
+        radices = [len(self.outcome_space[var]) + 1 for var in self.evidence_vars]
+        self.evidence_strides = [int(np.prod(radices[i + 1:])) for i in range(len(radices))]
 
-        return transition_factor.normalize()
+        if isinstance(self.emission_factor, SparseFactor):
+            keys = self.emission_factor.keys
+            codes = keys @ np.array(self.evidence_strides, dtype=keys.dtype)
+            self.emission_lookup = dict(zip(codes.tolist(), self.emission_factor.values))
+            missing_code = sum(
+                stride * (radix - 1) for stride, radix in zip(self.evidence_strides, radices))
+            self.emission_lookup[missing_code] = self._emission_likelihood_from_factor()
+            self.emission_misses = LRUCache(EMISSION_CACHE_SIZE)
+            return
 
-    def learn_emissions(self, alpha=2) -> Factor:
-        '''Learns the emission probabilities for the given room.'''
-        emission_factor = Utils.estimate_factor(
-            self.training_data, self.room, self.sensors, self.outcome_space, alpha)
+        f = self.emission_factor
+        table = np.transpose(
+            f.table, [f.domain.index(var) for var in self.evidence_vars + (self.room,)])
+        for axis in range(len(self.evidence_vars)):
+            table = np.concatenate([table, table.sum(axis=axis, keepdims=True)], axis=axis)
+        self.emission_lookup = table.reshape(-1, len(self.outcome_space[self.room]))
+
+    def evidence_code(self, **evidence) -> int:
+        '''
+        Returns the integer code of the evidence in the emission lookup table.
+        Variables that are missing, or have an unknown outcome, are coded as missing.
+        '''
+        code = 0
+        for var, codes, stride in zip(self.evidence_vars, self.evidence_codes, self.evidence_strides):
+            code += stride * codes.get(evidence.get(var), len(codes))
+        return code
+
+    def emission_likelihood(self, **evidence) -> np.ndarray:
+        '''
+        Returns the likelihood of each room outcome given the evidence, i.e. the emission factor with
+        the evidence set and every unobserved sensor summed out. This is a single table lookup.
+        '''
+        return self.code_likelihood(self.evidence_code(**evidence))
+
+    def code_likelihood(self, code: int) -> np.ndarray:
+        '''Returns the likelihood of each room outcome, given an evidence code (see evidence_code).'''
+        if isinstance(self.emission_lookup, dict):
+            likelihood = self.emission_lookup.get(code)
+            if likelihood is None:
+                likelihood = self.emission_misses.get(code)
+            if likelihood is None:
+                evidence = self.decode_evidence(code)
+                likelihood = self._emission_likelihood_from_factor(**evidence)
+                self.emission_misses.put(code, likelihood)
+            return likelihood
+        return self.emission_lookup[code]
+
+    def decode_evidence(self, code: int) -> dict[str, str]:
+        '''Returns the evidence of an evidence code, leaving out the variables coded as missing.'''
+        evidence = {}
+        for var, stride in zip(self.evidence_vars, self.evidence_strides):
+            digit, code = divmod(code, stride)
+            outcomes = self.outcome_space[var]
+            if digit < len(outcomes):
+                evidence[var] = outcomes[digit]
+        return evidence
+
+    def _emission_likelihood_from_factor(self, **evidence) -> np.ndarray:
+        '''Computes the room likelihoods directly from the emission factor.'''
+        f = self.emission_factor.evidence(**evidence)
+        for var in f.domain:
+            if var != self.room:
+                f = f.marginalize(var)
+        return f.table
+
+    def emission_matrix(self, data: pd.DataFrame) -> np.ndarray:
+        '''
+        Returns the (steps x states) emission likelihoods of a day of evidence, with one row per step
+        and a column per evidence variable. Missing columns or values count as missing evidence.
+        '''
+        evidence = data.reindex(columns=list(self.evidence_vars)).to_dict(orient='records')
+        return np.stack([self.emission_likelihood(**evi) for evi in evidence])
+
+    def _offline_hmm(self) -> HiddenMarkovModel:
+        '''
+        Returns a new HMM starting from the learned start state, so that offline runs leave the
+        internal state used by `prediction` untouched.
+        '''
+        return HiddenMarkovModel(
+            self.state_factor, self.transition_factor, self.emission_factor, self.var_remap)
+
+    def filter(self, data: pd.DataFrame) -> tuple[np.ndarray, float]:
+        '''
+        Replays a day of evidence from the learned start state, and returns the (steps x states)
+        filtered posteriors and the log likelihood of the evidence.
+        '''
+        return self._offline_hmm().forward_filter(self.emission_matrix(data))
+
+    def viterbi(self, data: pd.DataFrame) -> list[str]:
+        '''
+        Finds the most likely sequence of room outcomes over a day of evidence, starting from the
+        learned start state.
+        '''
+        with np.errstate(divide='ignore'):
+            log_likelihoods = np.log(self.emission_matrix(data))
+        return self._offline_hmm().viterbi_decode(log_likelihoods)
+
+    def learn_outcome_space(self) -> dict[str, tuple]:
+        '''Returns the outcome space of each variable, as encoded in the training data.'''
+        return { var: self.training_data.outcome_space[var] for var in self.vars }
+
+    def learn_counts(self) -> tuple:
+        '''
+        Counts the states, the transitions and the emissions of the room in the training data.
+        Only consecutive rows of the same day count as transitions.
+        '''
+        codes = self.training_data[self.room]
+        num_outcomes = len(self.outcome_space[self.room])
+        return (
+            count_states(codes, num_outcomes),
+            count_transitions(codes, num_outcomes, self.training_data.same_day_pairs()),
+            count_emissions(self.training_data, self.room, self.sensors, self.outcome_space))
+
+    @staticmethod
+    def states_from_counts(room: str, outcome_space: dict[str, tuple], counts) -> Factor:
+        '''Returns the state factor of a room from its outcome counts.'''
+        return Factor((room,), outcome_space, table=counts / counts.sum())
+
+    @staticmethod
+    def transitions_from_counts(room: str, outcome_space: dict[str, tuple], counts) -> Factor:
+        '''
+        Returns P(room_next | room) from the transition counts of a room. As in the original
+        learn_transitions, a move to another outcome weighs its share of all the transitions, and
+        staying put weighs as much as one cell of a uniform table, before each row is normalized.
+        This keeps rooms from sticking to an outcome once the evidence changes: trained on either
+        day and simulated on the other, it costs far less than the raw conditional frequencies.
+        Outcomes never seen in training get a uniform row.
+        '''
+        counts = np.asarray(counts, dtype=np.float64)
+        table = counts / max(counts.sum(), 1)
+        np.fill_diagonal(table, 1 / counts.size)
+        table = table / table.sum(axis=1, keepdims=True)
+        table[counts.sum(axis=1) == 0] = 1 / len(counts)
+        return Factor((room, room + '_next'), outcome_space, table=table)
+
+    @staticmethod
+    def emissions_from_counts(
+            room: str,
+            sensors: list[str],
+            outcome_space: dict[str, tuple],
+            counts: tuple,
+            alpha=EMISSION_ALPHA) -> Factor:
+        '''
+        Returns the emission factor of a room from the counts of `count_emissions`. Rooms with many
+        neighbours (e.g. c2) get a sparse factor, since almost all of their parent configurations
+        are never seen.
+        '''
+        if sparse_emissions(outcome_space, room, sensors):
+            emission_factor = Utils.sparse_factor_from_counts(
+                room, sensors, outcome_space, *counts, alpha)
+        else:
+            emission_factor = Utils.factor_from_counts(
+                room, sensors, outcome_space, *counts, alpha)
 
         return emission_factor.normalize()
-    
\ No newline at end of file
+
+
+###################################
+# Parallel training
+
+# Shared dataset the worker process is attached to, if any (see count_rooms_parallel)
+_worker_dataset = None
+
+def _init_worker() -> None:
+    '''Worker initializer: detaches from the shared training data when the worker exits.'''
+    util.Finalize(None, _detach_worker_dataset, exitpriority=0)
+
+def _detach_worker_dataset() -> None:
+    '''Closes the worker's handle on the shared training data, if any.'''
+    global _worker_dataset
+    if _worker_dataset is not None:
+        _worker_dataset.detach()
+        _worker_dataset = None
+
+def _attach_worker_dataset(description: dict) -> EncodedDataset:
+    '''
+    Returns the shared dataset of `description`. A worker attaches to each dataset (e.g. each day)
+    once, detaching from the previous one.
+    '''
+    global _worker_dataset
+    if _worker_dataset is None or _worker_dataset.shared_block.name != description['name']:
+        _detach_worker_dataset()
+        _worker_dataset = EncodedDataset.from_shared_memory(**description)
+    return _worker_dataset
+
+def _count_worker(description: dict, room: str, sensors: list[str]) -> tuple:
+    '''Counts one room of a shared dataset in a worker process.'''
+    dataset = _attach_worker_dataset(description)
+    codes = dataset[room]
+    num_outcomes = len(dataset.outcome_space[room])
+    return (
+        room,
+        count_states(codes, num_outcomes),
+        count_transitions(codes, num_outcomes, dataset.same_day_pairs()),
+        count_emissions(dataset, room, sensors, dataset.outcome_space))
+
+def _training_cost(dataset: EncodedDataset, room: str, sensors: list[str]) -> int:
+    '''Estimates the cost of training a room, as the number of cells of its emission table.'''
+    cost = 1
+    for var in [room] + sensors:
+        cost *= len(dataset.outcome_space[var])
+    return cost
+
+def training_pool(processes: int = None) -> Pool:
+    '''
+    Returns a pool of worker processes for `count_rooms_parallel` (os.cpu_count() by default).
+    Close and join the pool when done, since terminating it (e.g. by leaving a with statement)
+    skips the finalizer that closes the workers' handles on the shared data.
+    '''
+    # the workers must share this process's resource tracker, so it is started before they are
+    # forked: a worker with a tracker of its own would report the shared blocks leaked at exit
+    resource_tracker.ensure_running()
+    return Pool(processes, initializer=_init_worker)
+
+def count_rooms_parallel(
+        pool: Pool,
+        dataset: EncodedDataset,
+        room_evidences: dict[str, list[str]]) -> dict[str, tuple]:
+    '''
+    Counts the states, transitions and emissions of every room over a pool of `training_pool`, and
+    returns them by room. The encoded data is shared with the workers through shared memory while
+    counting, and the widest rooms are scheduled first, so that they do not end up running alone at
+    the end.
+    '''
+    order = sorted(
+        room_evidences,
+        key=lambda room: _training_cost(dataset, room, room_evidences[room]),
+        reverse=True)
+
+    block, description = dataset.to_shared_memory()
+    try:
+        results = pool.starmap(
+            _count_worker,
+            [(description, room, room_evidences[room]) for room in order],
+            chunksize=1)
+    finally:
+        block.close()
+        block.unlink()
+
+    # Keep the caller's room order
+    counts = { room: room_counts for room, *room_counts in results }
+    return { room: counts[room] for room in room_evidences }
+
+def train_predictors_parallel(
+        dataset: EncodedDataset,
+        room_evidences: dict[str, list[str]],
+        processes: int = None) -> dict[str, RoomPredictor]:
+    '''
+    Trains a RoomPredictor for every room of `dataset` over a pool of worker processes
+    (os.cpu_count() by default), see `count_rooms_parallel`.
+    '''
+    with training_pool(processes) as pool:
+        counts = count_rooms_parallel(pool, dataset, room_evidences)
+        pool.close()
+        pool.join()
+
+    predictors = {}
+    for room, sensors in room_evidences.items():
+        outcome_space = { var: dataset.outcome_space[var] for var in [room] + sensors }
+        outcome_space[room + '_next'] = outcome_space[room]
+        predictors[room] = RoomPredictor.from_counts(
+            room, sensors, outcome_space, *counts[room], training_data=dataset)
+    return predictors
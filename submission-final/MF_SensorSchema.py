@@ -0,0 +1,78 @@
+'''
+    Helper class to read the sensors of a building, compiled once.
+'''
+
+import numpy as np
+import MF_Utils as Utils
+from MF_DiscreteFactors import outcome_index
+
+def _bucket_people_count(count) -> str:
+    '''Buckets a raw count of people (which may be a string).'''
+    return Utils.bucket_people_count(int(count))
+
+def _unchanged(value):
+    '''Sensors that are already in their final format (e.g. motion sensors, robots).'''
+    return value
+
+def sensor_preprocessor(sensor: str):
+    '''Returns the function that turns a raw reading of `sensor` into its bucket.'''
+    if Utils.REGEX_TIME.match(sensor):
+        return Utils.bucket_time_of_day
+    if Utils.REGEX_PEOPLE_COUNT.match(sensor):
+        return _bucket_people_count
+    return _unchanged
+
+class SensorSchema:
+    '''
+    Helper class that compiles how every sensor of a building is read. Sensor names are fixed per
+    building, so each name is matched against the regexes once, and mapped to its preprocessing
+    function and to a column of a preallocated code array. Raw sensor dictionaries are then
+    encoded straight into that array.
+    '''
+
+    def __init__(self, columns: list[str], outcome_space: dict[str, tuple]) -> None:
+        '''
+        columns: the variables to encode, e.g. the evidence of every room (including <room>_last
+            variables, which are set by the caller).
+        outcome_space: the outcomes of every column, a column's code being its outcome index.
+        '''
+        self.columns = list(columns)
+        self.column_index = { column: i for i, column in enumerate(self.columns) }
+        self.outcome_space = { column: tuple(outcome_space[column]) for column in self.columns }
+        self.outcome_codes = {
+            column: outcome_index(outcomes) for column, outcomes in self.outcome_space.items() }
+
+        # sensors outside the columns (e.g. robots) are compiled the first time they are seen
+        self.preprocessors = { column: sensor_preprocessor(column) for column in self.columns }
+
+        # reused by every call to encode
+        self.codes = np.full(len(self.columns), -1, dtype=np.intp)
+
+    def preprocessor(self, sensor: str):
+        '''Returns the preprocessing function of a sensor.'''
+        preprocess = self.preprocessors.get(sensor)
+        if preprocess is None:
+            preprocess = self.preprocessors[sensor] = sensor_preprocessor(sensor)
+        return preprocess
+
+    def process(self, sensor_data: dict[str]) -> dict[str]:
+        '''Buckets every reading of a raw sensor dictionary, dropping the missing ones.'''
+        return {
+            sensor: self.preprocessor(sensor)(value)
+            for sensor, value in sensor_data.items()
+            if value is not None }
+
+    def encode(self, sensor_data: dict[str]) -> np.ndarray:
+        '''
+        Encodes a raw sensor dictionary into the code array, which is reused (and overwritten) by
+        every call. Columns whose reading is missing, None or outside their outcome space are -1,
+        and sensors that are not columns are ignored.
+        '''
+        codes = self.codes
+        codes.fill(-1)
+        for sensor, value in sensor_data.items():
+            i = self.column_index.get(sensor)
+            if i is None or value is None:
+                continue
+            codes[i] = self.outcome_codes[sensor].get(self.preprocessors[sensor](value), -1)
+        return codes
@@ -0,0 +1,140 @@
+'''
+    Helper class to train RoomPredictors over many days of sensor logs.
+'''
+
+import numpy as np
+import pandas as pd
+import MF_Utils as Utils
+from MF_EncodedDataset import EncodedDataset
+from MF_RoomPredictor import (
+    RoomPredictor,
+    count_emissions,
+    count_rooms_parallel,
+    count_states,
+    count_transitions,
+    sparse_emissions,
+    training_pool)
+
+class StreamingTrainer:
+    '''
+    Helper class that trains RoomPredictors from one CSV log per day, reading each day in chunks.
+    A chunk only adds to the sufficient statistics (count tensors) of the states, transitions and
+    emissions of every room, so at most one chunk of readings is held in memory at a time. The
+    factors are finalized from the accumulated counts by `predictors`.
+    '''
+
+    def __init__(
+            self,
+            room_evidences: dict[str, list[str]],
+            outcome_space: dict[str, tuple]) -> None:
+        '''
+        `outcome_space` must hold the outcomes of every room and evidence variable, since chunks
+        are encoded separately (see Utils.bucket_outcomes and Utils.scan_outcomes).
+        '''
+        self.room_evidences = room_evidences
+        self.columns = list(dict.fromkeys(
+            var for room, evidence in room_evidences.items() for var in [room] + evidence))
+        self.outcome_space = { col: tuple(outcome_space[col]) for col in self.columns }
+        self.num_days = 0
+
+        # Setup count tensors; emission counts are created by the first chunk
+        self.state_counts = {}
+        self.transition_counts = {}
+        self.emission_counts = { room: None for room in room_evidences }
+        for room in room_evidences:
+            num_outcomes = len(self.outcome_space[room])
+            self.state_counts[room] = np.zeros(num_outcomes, dtype=np.int64)
+            self.transition_counts[room] = np.zeros((num_outcomes, num_outcomes), dtype=np.int64)
+
+    def room_outcome_space(self, room: str) -> dict[str, tuple]:
+        '''Returns the outcome space of a room's predictor.'''
+        room_vars = [room] + self.room_evidences[room]
+        outcome_space = { var: self.outcome_space[var] for var in room_vars }
+        outcome_space[room + '_next'] = outcome_space[room]
+        return outcome_space
+
+    def add_day(self, filename: str, chunksize=1000) -> None:
+        '''Adds a day of readings (one CSV file) to the counts, `chunksize` rows at a time.'''
+        previous_row = None
+        previous_codes = None
+        for chunk in pd.read_csv(filename, header=[0], index_col=[0], chunksize=chunksize):
+            # the first row of a chunk continues from the last row of the previous one
+            chunk = Utils.preprocess_readings(chunk, previous_row)
+            previous_row = chunk.iloc[-1]
+
+            dataset = EncodedDataset(chunk, self.outcome_space, self.columns)
+            self.add_chunk(dataset, previous_codes)
+            previous_codes = dataset.codes[-1]
+
+        self.num_days += 1
+
+    def add_days_parallel(self, filenames: list[str], processes: int = None) -> None:
+        '''
+        Adds days of readings (one CSV file each) to the counts, counting the rooms of each day over
+        a pool of worker processes (os.cpu_count() by default). Unlike `add_day`, a whole day is
+        read at once, but days are still read one at a time.
+        '''
+        with training_pool(processes) as pool:
+            for filename in filenames:
+                day = Utils.preprocess_readings(pd.read_csv(filename, header=[0], index_col=[0]))
+                dataset = EncodedDataset(day, self.outcome_space, self.columns)
+                for room, counts in count_rooms_parallel(pool, dataset, self.room_evidences).items():
+                    self.add_counts(room, *counts)
+                self.num_days += 1
+            pool.close()
+            pool.join()
+
+    def add_chunk(self, dataset: EncodedDataset, previous_codes: np.ndarray = None) -> None:
+        '''
+        Adds an encoded chunk of readings to the counts. `previous_codes` is the last encoded row of
+        the previous chunk of the same day, if any, so that the transition between them is counted.
+        '''
+        same_day = dataset.same_day_pairs()
+        for room, sensors in self.room_evidences.items():
+            codes = dataset[room]
+            num_outcomes = len(self.outcome_space[room])
+            self.add_counts(
+                room,
+                count_states(codes, num_outcomes),
+                count_transitions(codes, num_outcomes, same_day),
+                count_emissions(dataset, room, sensors, self.outcome_space))
+
+            if previous_codes is not None and len(codes) > 0:
+                room_t0 = previous_codes[dataset.column_index[room]]
+                if room_t0 >= 0 and codes[0] >= 0:
+                    self.transition_counts[room][room_t0, codes[0]] += 1
+
+    def add_counts(
+            self,
+            room: str,
+            state_counts: np.ndarray,
+            transition_counts: np.ndarray,
+            emission_counts: tuple) -> None:
+        '''Adds counts of a room (see RoomPredictor.learn_counts) to the accumulated ones.'''
+        self.state_counts[room] += state_counts
+        self.transition_counts[room] += transition_counts
+        self.emission_counts[room] = self._add_emission_counts(room, emission_counts)
+
+    def _add_emission_counts(self, room: str, counts: tuple) -> tuple:
+        '''Adds new emission counts of a room to the accumulated ones.'''
+        accumulated = self.emission_counts[room]
+        if accumulated is None:
+            return counts
+        if sparse_emissions(self.outcome_space, room, self.room_evidences[room]):
+            return Utils.merge_sparse_counts(accumulated, counts)
+        return tuple(total + new for total, new in zip(accumulated, counts))
+
+    def predictors(self) -> dict[str, RoomPredictor]:
+        '''Finalizes a RoomPredictor for every room from the accumulated counts.'''
+        if any(counts is None for counts in self.emission_counts.values()):
+            raise ValueError('No readings have been added')
+
+        return {
+            room: RoomPredictor.from_counts(
+                room,
+                sensors,
+                self.room_outcome_space(room),
+                self.state_counts[room],
+                self.transition_counts[room],
+                self.emission_counts[room])
+            for room, sensors in self.room_evidences.items() }
@@ -2,14 +2,14 @@
     Helper file to store regexes, factor estimation, etc.
 '''
 
+import bisect
 import datetime as dt
 import re
-from itertools import product
-
 import numpy as np
 import pandas as pd
 
-from MF_DiscreteFactors import Factor
+from MF_DiscreteFactors import Factor, SparseFactor
+from MF_EncodedDataset import EncodedDataset, encode_column
 
 ###################################
 # Regex helpers
@@ -20,6 +20,9 @@ REGEX_MOTION_SENSOR = re.compile(r'^motion_sensor[0-9]*$')
 # column values: tuple(room, # of people)
 REGEX_ROBOT = re.compile(r'^robot[0-9]*$')
 
+# robot reading, e.g. "('r1', 3)"
+REGEX_ROBOT_READING = re.compile(r"\('(\w+)',\s*(\d+)\)")
+
 # column values: date time
 REGEX_TIME = re.compile(r'^time$')
 
@@ -40,10 +43,15 @@ REGEX_PEOPLE_COUNT = re.compile('|'.join([
     REGEX_ROOM_LAST,
     REGEX_CORRIDOR_LAST]))
 
+# column values: # of people, also kept from the previous tick as <column>_last
+REGEX_OCCUPANCY = re.compile('|'.join([REGEX_ROOM, REGEX_CORRIDOR, REGEX_OUTSIDE]))
+
 ###################################
 # Buckets for replacing values
 
 PEOPLE_COUNT_BUCKETS = ('0', '<3', '<10', '>=10')
+# lower edges of every people count bucket but the first
+PEOPLE_COUNT_EDGES = (1, 3, 10)
 TIME_BUCKETS = tuple(str(x) for x in range(8, 19))
 
 def parse_str_to_time(time_str: str) -> dt.datetime:
@@ -51,54 +59,271 @@ def parse_str_to_time(time_str: str) -> dt.datetime:
     return dt.datetime.strptime(time_str, '%H:%M:%S')
 
 def bucket_time_of_day(time) -> str:
-    '''Buckets timing into hour.'''
+    '''Buckets timing into hour. Raises a ValueError for hours outside TIME_BUCKETS.'''
     if isinstance(time, str):
         index = int(time[:2]) - 8
     else:
         index = time.hour - 8
 
+    if not 0 <= index < len(TIME_BUCKETS):
+        raise ValueError(
+            f'Time {time} is outside of the hours {TIME_BUCKETS[0]} to {TIME_BUCKETS[-1]}')
     return TIME_BUCKETS[index]
 
 def bucket_people_count(count: int) -> str:
     '''Buckets count of people.'''
-    if count == 0:
-        return PEOPLE_COUNT_BUCKETS[0]
-    if count < 3:
-        return PEOPLE_COUNT_BUCKETS[1]
-    if count < 10:
-        return PEOPLE_COUNT_BUCKETS[2]
-    return PEOPLE_COUNT_BUCKETS[3]
-
-def _all_equal_this_index(dict_of_arrays: dict[list], **fixed_vars) -> np.ndarray:
-    '''Source: Assignment 1 solution.'''
-    # base index is a boolean vector, everywhere true
-    first_array = dict_of_arrays[list(dict_of_arrays.keys())[0]]
-    index = np.ones_like(first_array, dtype=np.bool_)
-    for var_name, var_val in fixed_vars.items():
-        index = index & (np.asarray(dict_of_arrays[var_name])==var_val)
-    return index
+    return PEOPLE_COUNT_BUCKETS[bisect.bisect_right(PEOPLE_COUNT_EDGES, count)]
+
+def parse_robot_reading(reading) -> tuple[str, int]:
+    '''Parses a robot reading into its (room, # of people), or returns None if there is none.'''
+    if reading is None:
+        return None
+    match = REGEX_ROBOT_READING.search(str(reading))
+    if match is None:
+        return None
+    return match.group(1), int(match.group(2))
+
+def bucket_times_of_day(times: pd.Series) -> pd.Series:
+    '''
+    Vectorized `bucket_time_of_day` for a column of 'HH:MM:SS' strings. Returns an ordered
+    categorical column over TIME_BUCKETS, and raises a ValueError for hours outside of them.
+    '''
+    codes = times.str.slice(0, 2).astype(np.int8).to_numpy() - 8
+    outside = (codes < 0) | (codes >= len(TIME_BUCKETS))
+    if np.any(outside):
+        raise ValueError(
+            f'Time {times[outside].iloc[0]} is outside of the hours '
+            f'{TIME_BUCKETS[0]} to {TIME_BUCKETS[-1]}')
+    categorical = pd.Categorical.from_codes(codes, categories=TIME_BUCKETS, ordered=True)
+    return pd.Series(categorical, index=times.index, name=times.name)
+
+def bucket_people_counts(counts: pd.Series) -> pd.Series:
+    '''
+    Vectorized `bucket_people_count` for a column of counts. Returns an ordered categorical column
+    over PEOPLE_COUNT_BUCKETS (missing counts stay missing).
+    '''
+    values = counts.to_numpy(dtype=np.float64)
+    codes = np.digitize(values, PEOPLE_COUNT_EDGES).astype(np.int8)
+    codes[np.isnan(values)] = -1
+    categorical = pd.Categorical.from_codes(codes, categories=PEOPLE_COUNT_BUCKETS, ordered=True)
+    return pd.Series(categorical, index=counts.index, name=counts.name)
+
+def bucket_outcomes(columns: list[str]) -> dict[str, tuple]:
+    '''
+    Returns the fixed outcome space of every bucketed column in `columns`, so that data read in
+    separate pieces (days, chunks) is always encoded the same way. The outcomes of the other
+    columns (e.g. motion sensors) come from the data, see `scan_outcomes`.
+    '''
+    outcome_space = {}
+    for col in columns:
+        if REGEX_TIME.match(col):
+            outcome_space[col] = TIME_BUCKETS
+        elif REGEX_PEOPLE_COUNT.match(col):
+            outcome_space[col] = PEOPLE_COUNT_BUCKETS
+    return outcome_space
+
+def observed_outcomes(frames, columns: list[str]) -> dict[str, tuple]:
+    '''Returns the sorted distinct values (but missing ones) of `columns` over some DataFrames.'''
+    values = { col: set() for col in columns }
+    for frame in frames:
+        for col in columns:
+            values[col].update(frame[col].dropna().unique())
+    return { col: tuple(sorted(values[col], key=str)) for col in columns }
+
+def scan_outcomes(filenames: list[str], columns: list[str], chunksize=10000) -> dict[str, tuple]:
+    '''
+    Returns the outcomes of unbucketed `columns` (see `observed_outcomes`) over raw CSV logs,
+    reading only those columns, `chunksize` rows at a time.
+    '''
+    frames = (
+        chunk
+        for filename in filenames
+        for chunk in pd.read_csv(filename, usecols=columns, chunksize=chunksize))
+    return observed_outcomes(frames, columns)
+
+def preprocess_readings(df: pd.DataFrame, previous: pd.Series = None) -> pd.DataFrame:
+    '''
+    Buckets raw sensor readings (one row per tick), and adds a <column>_last column holding the
+    previous tick's occupancy of every room, corridor and the outside.
+    `previous` is the last preprocessed row before `df` on the same day (e.g. the end of the
+    previous chunk). At the start of a day, every room is empty and everyone is outside.
+    '''
+    # Set all columns
+    for col in df.columns:
+        if REGEX_MOTION_SENSOR.match(col):
+            # Data already in binary format
+            pass
+        elif REGEX_ROBOT.match(col):
+            # Tuple parsed later
+            pass
+        elif REGEX_TIME.match(col):
+            # Technically not necessary
+            df[col] = bucket_times_of_day(df[col])
+        elif REGEX_PEOPLE_COUNT.match(col):
+            # Replace with buckets
+            df[col] = bucket_people_counts(df[col])
+
+    # set up dataframe to use the past value of neighbouring rooms
+    occupancy = [col for col in df.columns if REGEX_OCCUPANCY.match(col)]
+    shifted = df[occupancy].shift(1)
+    if previous is None:
+        # fill in t-1 bracket as no one there
+        shifted.iloc[0] = ['>=10' if col == 'outside' else '0' for col in occupancy]
+    else:
+        shifted.iloc[0] = previous[occupancy].to_list()
+    shifted.columns = [col + '_last' for col in occupancy]
+
+    # combine data
+    return pd.concat([df, shifted], axis=1)
+
+def column_codes(data, var_name: str, outcomes: tuple) -> np.ndarray:
+    '''
+    Returns the integer codes of a column against its outcome space. Encoded datasets are read
+    directly, anything indexable by column name (DataFrame, dict of arrays) is encoded.
+    '''
+    if isinstance(data, EncodedDataset):
+        return data.codes_of(var_name, outcomes)
+    return encode_column(data[var_name], outcomes)
+
+def count_outcomes(codes: list[np.ndarray], shape: tuple[int]) -> np.ndarray:
+    '''
+    Counts every joint outcome of the given integer-encoded columns in a single pass.
+    Each row is flattened into a mixed-radix index over `shape`, so the whole count tensor comes out
+    of one bincount. Rows with any code of -1 are not counted.
+    '''
+    valid = np.ones(len(codes[0]), dtype=np.bool_)
+    for column in codes:
+        valid &= column >= 0
+
+    flat_index = np.ravel_multi_index(tuple(column[valid] for column in codes), shape)
+    counts = np.bincount(flat_index, minlength=int(np.prod(shape)))
+    return counts.reshape(shape)
+
+def count_factor(
+        data: pd.DataFrame | EncodedDataset,
+        var_name: str,
+        parent_names: list[str],
+        outcome_space: dict[str, tuple]) -> tuple[np.ndarray, np.ndarray | int]:
+    '''
+    Counts the sufficient statistics of P(var_name | parent_names): the joint counts N(parents, var)
+    and the parent counts N(parents). Counts of separate pieces of data can simply be added.
+    '''
+    domain = list(parent_names) + [var_name]
+    shape = tuple(len(outcome_space[var]) for var in domain)
+
+    # integer-encode each column once
+    codes = [column_codes(data, var, outcome_space[var]) for var in domain]
+
+    # joint counts N(parents, var) and parent counts N(parents)
+    counts = count_outcomes(codes, shape)
+    if parent_names:
+        parent_counts = count_outcomes(codes[:-1], shape[:-1])[..., np.newaxis]
+    else:
+        parent_counts = len(codes[-1])
+
+    return counts, parent_counts
+
+def factor_from_counts(
+        var_name: str,
+        parent_names: list[str],
+        outcome_space: dict[str, tuple],
+        counts: np.ndarray,
+        parent_counts: np.ndarray | int,
+        alpha=1) -> Factor:
+    '''Estimates P(var_name | parent_names) from the counts of `count_factor`.'''
+    domain = list(parent_names) + [var_name]
+    table = (counts + alpha) / (parent_counts + alpha * len(outcome_space[var_name]))
+    return Factor(domain, outcome_space, table=table)
 
 def estimate_factor(
-        data: pd.DataFrame,
+        data: pd.DataFrame | EncodedDataset,
         var_name: str,
         parent_names: list[str],
         outcome_space: dict[str, tuple],
         alpha=1) -> Factor:
-    '''Source: Assignment 1 solution.'''
+    '''
+    Estimates P(var_name | parent_names) from data with additive (alpha) smoothing.
+    Source: Assignment 1 solution, rewritten to count all parent combinations in one pass.
+    '''
+    counts, parent_counts = count_factor(data, var_name, parent_names, outcome_space)
+    return factor_from_counts(var_name, parent_names, outcome_space, counts, parent_counts, alpha)
+
+def count_sparse_factor(
+        data: pd.DataFrame | EncodedDataset,
+        var_name: str,
+        parent_names: list[str],
+        outcome_space: dict[str, tuple]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    Same counts as `count_factor`, but only over the parent configurations present in the data.
+    Returns the flat index of each seen configuration (sorted), its count N(parents), and its
+    joint counts N(parents, var). Counts of separate pieces of data are added with
+    `merge_sparse_counts`. Requires at least one parent.
+    '''
     var_outcomes = outcome_space[var_name]
-    parent_outcomes = [outcome_space[var] for var in (parent_names)]
-    # cartesian product to generate a table of all possible outcomes
-    all_parent_combinations = product(*parent_outcomes)
-
-    f = Factor(list(parent_names)+[var_name], outcome_space)
-
-    for _, parent_combination in enumerate(all_parent_combinations):
-        parent_vars = dict(zip(parent_names, parent_combination))
-        parent_index = _all_equal_this_index(data, **parent_vars)
-        for var_outcome in var_outcomes:
-            var_index = np.asarray(data[var_name]) == var_outcome
-            f[tuple(list(parent_combination) + [var_outcome])] = (
-            ((var_index & parent_index).sum() + alpha) / (parent_index.sum() + alpha * len(var_outcomes))
-            )
-
-    return f
+    parent_shape = tuple(len(outcome_space[var]) for var in parent_names)
+
+    parent_codes = [column_codes(data, var, outcome_space[var]) for var in parent_names]
+    var_codes = column_codes(data, var_name, var_outcomes)
+
+    # index of each row's parent configuration, among the configurations seen in the data
+    valid = np.ones(len(var_codes), dtype=np.bool_)
+    for column in parent_codes:
+        valid &= column >= 0
+    parent_index = np.ravel_multi_index(
+        tuple(column[valid] for column in parent_codes), parent_shape)
+    seen, inverse = np.unique(parent_index, return_inverse=True)
+    var_codes = var_codes[valid]
+
+    # counts N(parents) and N(parents, var) over seen configurations only
+    parent_counts = np.bincount(inverse, minlength=len(seen))[:, np.newaxis]
+    counted = var_codes >= 0
+    counts = np.bincount(
+        inverse[counted] * len(var_outcomes) + var_codes[counted],
+        minlength=len(seen) * len(var_outcomes)).reshape(len(seen), len(var_outcomes))
+
+    return seen, parent_counts, counts
+
+def merge_sparse_counts(first: tuple[np.ndarray, ...], second: tuple[np.ndarray, ...]) -> tuple:
+    '''Adds two sets of counts from `count_sparse_factor`, over the union of configurations.'''
+    seen, inverse = np.unique(np.concatenate([first[0], second[0]]), return_inverse=True)
+    merged = [seen]
+    for first_counts, second_counts in zip(first[1:], second[1:]):
+        counts = np.zeros((len(seen), first_counts.shape[1]), dtype=np.int64)
+        np.add.at(counts, inverse, np.concatenate([first_counts, second_counts]))
+        merged.append(counts)
+    return tuple(merged)
+
+def sparse_factor_from_counts(
+        var_name: str,
+        parent_names: list[str],
+        outcome_space: dict[str, tuple],
+        seen: np.ndarray,
+        parent_counts: np.ndarray,
+        counts: np.ndarray,
+        alpha=1) -> SparseFactor:
+    '''
+    Estimates P(var_name | parent_names) from the counts of `count_sparse_factor`. Every parent
+    configuration that was never seen gets the smoothed prior alpha / (alpha * |var outcomes|).
+    '''
+    var_outcomes = outcome_space[var_name]
+    parent_shape = tuple(len(outcome_space[var]) for var in parent_names)
+
+    values = (counts + alpha) / (parent_counts + alpha * len(var_outcomes))
+    default = np.full(len(var_outcomes), alpha / (alpha * len(var_outcomes)))
+    keys = np.stack(np.unravel_index(seen, parent_shape), axis=1)
+
+    return SparseFactor(parent_names, [var_name], outcome_space, keys, values, default)
+
+def estimate_sparse_factor(
+        data: pd.DataFrame | EncodedDataset,
+        var_name: str,
+        parent_names: list[str],
+        outcome_space: dict[str, tuple],
+        alpha=1) -> SparseFactor:
+    '''
+    Same estimate as `estimate_factor`, but only the parent configurations present in the data are
+    stored. Every other configuration gets the smoothed prior alpha / (alpha * |var outcomes|).
+    Requires at least one parent.
+    '''
+    counts = count_sparse_factor(data, var_name, parent_names, outcome_space)
+    return sparse_factor_from_counts(var_name, parent_names, outcome_space, *counts, alpha)
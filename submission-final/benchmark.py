@@ -0,0 +1,155 @@
+'''
+Benchmarks for the hot paths of the model.
+Run from this folder with `python benchmark.py`. The room predictors are loaded from the model
+cache (or trained) first.
+'''
+
+import copy
+import time
+import tracemalloc
+
+import numpy as np
+
+import solution
+from MF_BayesNet_VE import BayesNet
+from MF_DiscreteFactors import Factor
+from MF_Graph import Graph
+
+room_predictors = solution.load_room_predictors()
+
+###################################
+# Helpers
+
+def load_evidence(filename='data1.csv', ticks=200) -> list[dict]:
+    '''Loads the first `ticks` rows of a day as evidence dictionaries, like get_action sees them.'''
+    data = solution.setup_training_data(filename)
+    evidence_vars = {
+        var
+        for predictor in room_predictors.values()
+        for var in predictor.sensors }
+    columns = [col for col in data.columns if col in evidence_vars]
+    return data[columns].iloc[:ticks].to_dict(orient='records')
+
+def measure(step, evidence_list: list[dict]) -> tuple[float, float]:
+    '''
+    Runs `step(evidence)` for every tick, and returns the mean time (ms) and the mean peak of
+    memory allocated during a tick (KiB), as traced by tracemalloc.
+    '''
+    peaks = []
+    tracemalloc.start()
+    start = time.perf_counter()
+    for evidence in evidence_list:
+        before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        step(evidence)
+        _, peak = tracemalloc.get_traced_memory()
+        peaks.append(peak - before)
+    elapsed = time.perf_counter() - start
+    tracemalloc.stop()
+
+    return 1000 * elapsed / len(evidence_list), np.mean(peaks) / 1024
+
+###################################
+# Factor evidence: copy-free vs deepcopy
+
+def legacy_evidence2(self, **kwargs):
+    '''The previous Factor.evidence2, which deep-copies the factor before slicing it.'''
+    f = copy.deepcopy(self)
+    indices = tuple(
+        self.outcome_space[v].index(kwargs[v])
+        if v in kwargs else slice(None)
+        for v in self.domain)
+    f.table = f.table[indices]
+    f.domain = tuple(v for v in f.domain if v not in kwargs)
+    return f
+
+def hmm_tick(evidence: dict) -> None:
+    '''One tick of the factor-based HMM for every room.'''
+    for predictor in room_predictors.values():
+        predictor.hmm.forward(normalize=True, **evidence)
+
+def benchmark_evidence(evidence_list: list[dict]) -> None:
+    '''Compares allocations per tick of the factor-based HMM, with and without copy-free evidence.'''
+    copy_free = Factor.evidence2
+    results = {}
+    for name, evidence2 in (('deepcopy', legacy_evidence2), ('copy-free', copy_free)):
+        Factor.evidence2 = evidence2
+        try:
+            results[name] = measure(hmm_tick, evidence_list)
+        finally:
+            Factor.evidence2 = copy_free
+
+    print('Factor.evidence in HiddenMarkovModel.forward (all rooms, per tick)')
+    for name, (ms, kib) in results.items():
+        print(f'  {name:>10}: {ms:8.3f} ms   {kib:10.1f} KiB peak allocated')
+
+###################################
+# BayesNet.query: pruned vs whole network
+
+def sensor_network(filename='data1.csv') -> BayesNet:
+    '''
+    A BayesNet of one tick of the rooms with a sensor: each room depends on its neighbours at the
+    previous tick (<room>_last), and causes its sensor readings.
+    '''
+    graph = Graph()
+    for room, predictor in room_predictors.items():
+        if all(var.endswith('_last') for var in predictor.sensors):
+            continue
+        for var in predictor.sensors:
+            if var.endswith('_last'):
+                graph.add_edge(var, room)
+            else:
+                graph.add_edge(room, var)
+
+    # the outcomes of every variable, as the predictors were trained on
+    outcome_space = {}
+    for predictor in room_predictors.values():
+        outcome_space |= predictor.outcome_space
+
+    columns = list(graph.adj_list)
+    bn = BayesNet(graph, { var: outcome_space[var] for var in columns })
+    bn.learnParameters(solution.setup_training_data(filename)[columns])
+    return bn
+
+def benchmark_pruning(evidence_list: list[dict]) -> None:
+    '''Compares BayesNet.query on every sensor room, with and without pruning the network.'''
+    bn = sensor_network()
+    rooms = [room for room in room_predictors if room in bn.factors]
+    queries = [
+        ([room], { var: value for var, value in evidence.items()
+                   if var in bn.factors and var != room and value == value })
+        for evidence in evidence_list for room in rooms ]
+
+    def run(_):
+        for q_vars, q_evi in queries:
+            bn.query(q_vars, **q_evi)
+
+    results = {}
+    for name, prune in (('whole', False), ('pruned', True)):
+        bn.prune = prune
+        run(None)  # plan every query first
+        results[name] = measure(run, [None])
+
+    pruned = np.mean([
+        bn.query(q_vars, return_stats=True, **q_evi)[1]['pruned'] for q_vars, q_evi in queries ])
+    print(f'BayesNet.query ({len(queries)} queries, {len(bn.factors)} factors)')
+    for name, (ms, kib) in results.items():
+        print(f'  {name:>10}: {ms / len(queries):8.3f} ms   {kib:10.1f} KiB peak allocated')
+    print(f'  {pruned:.1f} factors pruned per query on average')
+
+def benchmark_orders() -> None:
+    '''Compares the cost (table cells joined by VE) of each elimination heuristic.'''
+    bn = sensor_network()
+    print(f'Elimination orders ({len(bn.factors)} factors)')
+    for heuristic in (bn.minDegree, bn.minFill, bn.weightedMinFill, bn.cheapestOrder):
+        start = time.perf_counter()
+        order = heuristic()
+        ms = 1000 * (time.perf_counter() - start)
+        print(f'  {heuristic.__name__:>15}: {bn.cost(order):10d} cells   width {bn.width(order):2d}'
+              f'   {ms:8.3f} ms')
+
+if __name__ == '__main__':
+    evidence_ticks = load_evidence()
+    benchmark_evidence(evidence_ticks)
+    benchmark_pruning(evidence_ticks[:20])
+    benchmark_orders()
@@ -0,0 +1,37 @@
+'''
+    Shared fixtures of the tests. The modules live in the folder above, next to solution.py.
+'''
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import MF_Utils as Utils
+
+@pytest.fixture
+def rng() -> np.random.Generator:
+    return np.random.default_rng(9418)
+
+@pytest.fixture
+def readings(rng) -> pd.DataFrame:
+    '''A small day of bucketed readings: two rooms, a motion sensor and a camera.'''
+    n = 300
+    people = rng.choice(Utils.PEOPLE_COUNT_BUCKETS, size=(n, 3), p=[0.5, 0.3, 0.15, 0.05])
+    return pd.DataFrame({
+        'r1': people[:, 0],
+        'r2': people[:, 1],
+        'camera1': people[:, 2],
+        'motion_sensor1': rng.choice(['motion', 'no motion'], size=n),
+    })
+
+@pytest.fixture
+def outcome_space(readings) -> dict[str, tuple]:
+    '''The outcomes of the readings: fixed buckets, and the motion values in the data.'''
+    return (
+        Utils.bucket_outcomes(list(readings.columns))
+        | Utils.observed_outcomes([readings], ['motion_sensor1']))
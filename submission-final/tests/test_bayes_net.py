@@ -0,0 +1,213 @@
+'''
+    Tests of MF_BayesNet_VE (and MF_JunctionTree) against the joint distribution of a small network.
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from MF_BayesNet_VE import BayesNet
+from MF_Graph import Graph
+
+EDGES = [
+    ('A', 'B'), ('A', 'C'), ('B', 'D'), ('C', 'D'), ('D', 'E'), ('F', 'E'), ('C', 'G'), ('G', 'H')]
+OUTCOME_SPACE = {
+    'A': ('a0', 'a1'),
+    'B': ('b0', 'b1'),
+    'C': ('c0', 'c1', 'c2'),
+    'D': ('d0', 'd1'),
+    'E': ('e0', 'e1'),
+    'F': ('f0', 'f1', 'f2'),
+    'G': ('g0', 'g1'),
+    'H': ('h0', 'h1', 'h2'),
+}
+
+# (query vars, evidence) pairs, covering barren and d-separated nodes
+QUERIES = [
+    (['A'], {}),
+    (['A'], { 'E': 'e1' }),
+    (['D'], { 'A': 'a0', 'F': 'f2' }),
+    (['B', 'C'], { 'E': 'e0', 'H': 'h1' }),
+    (['H'], { 'C': 'c2' }),
+    (['F'], { 'D': 'd1' }),
+    (['G'], { 'A': 'a1', 'E': 'e1', 'F': 'f0' }),
+]
+
+@pytest.fixture
+def bn(rng) -> BayesNet:
+    '''A network learned from random readings.'''
+    graph = Graph()
+    for parent, child in EDGES:
+        graph.add_edge(parent, child)
+    bn = BayesNet(graph, OUTCOME_SPACE)
+    bn.learnParameters(random_readings(rng, 400))
+    return bn
+
+def random_readings(rng, n) -> pd.DataFrame:
+    return pd.DataFrame({
+        var: rng.choice(outcomes, size=n) for var, outcomes in OUTCOME_SPACE.items() })
+
+def brute_force(bn: BayesNet, q_vars: list, **evidence) -> np.ndarray:
+    '''P(q_vars | evidence) from the full joint distribution, with axes in q_vars order.'''
+    f = bn.joint().evidence(**evidence)
+    for var in f.domain:
+        if var not in q_vars:
+            f = f.marginalize(var)
+    return table_in_order(f.normalize(), q_vars)
+
+def table_in_order(f, variables: list) -> np.ndarray:
+    return np.transpose(f.table, [f.domain.index(var) for var in variables])
+
+@pytest.mark.parametrize('q_vars, evidence', QUERIES)
+def test_query_matches_joint(bn, q_vars, evidence):
+    np.testing.assert_allclose(
+        table_in_order(bn.query(q_vars, **evidence), q_vars), brute_force(bn, q_vars, **evidence))
+
+def test_cached_plans_answer_other_evidence_values(bn):
+    for value in OUTCOME_SPACE['E'] + OUTCOME_SPACE['E']:
+        np.testing.assert_allclose(
+            table_in_order(bn.query(['A'], E=value, F='f1'), ['A']),
+            brute_force(bn, ['A'], E=value, F='f1'))
+    assert len(bn.order_cache) == 1
+
+def test_relearning_forgets_cached_plans(bn, rng):
+    bn.query(['A'], E='e1')
+    bn.learnParameters(random_readings(rng, 50))
+    assert len(bn.order_cache) == 0
+    np.testing.assert_allclose(
+        table_in_order(bn.query(['A'], E='e1'), ['A']), brute_force(bn, ['A'], E='e1'))
+
+def test_query_leaves_the_network_unchanged(bn):
+    before = { node: (f.domain, f.table.copy()) for node, f in bn.factors.items() }
+    for q_vars, evidence in QUERIES:
+        bn.query(q_vars, **evidence)
+    for node, f in bn.factors.items():
+        assert f.domain == before[node][0]
+        np.testing.assert_array_equal(f.table, before[node][1])
+
+def test_concurrent_queries_match_sequential(bn):
+    def run(query):
+        q_vars, evidence = query
+        return table_in_order(bn.query(q_vars, **evidence), q_vars)
+
+    expected = [run(query) for query in QUERIES]
+    bn.invalidate_orders()
+    with ThreadPoolExecutor(4) as pool:
+        results = list(pool.map(run, QUERIES * 20))
+    for i, result in enumerate(results):
+        np.testing.assert_allclose(result, expected[i % len(QUERIES)])
+
+def test_junction_tree_marginals_match_queries(bn):
+    jt = bn.compile()
+    for _, evidence in QUERIES:
+        jt.clear_evidence()
+        jt.set_evidence(**evidence)
+        marginals = jt.marginals()
+        assert set(marginals) == set(OUTCOME_SPACE)
+        for var, marginal in marginals.items():
+            if var in evidence:
+                continue
+            np.testing.assert_allclose(marginal.table, bn.query([var], **evidence).table)
+            np.testing.assert_allclose(marginal.table, brute_force(bn, [var], **evidence))
+
+def test_junction_tree_updates_evidence_incrementally(bn):
+    jt = bn.compile(bn.minDegree())
+    evidence = {}
+    for var, value in [('E', 'e1'), ('H', 'h0'), ('E', 'e0'), ('A', 'a1'), ('H', None)]:
+        jt.set_evidence(**{ var: value })
+        if value is None:
+            del evidence[var]
+        else:
+            evidence[var] = value
+        for query in ['B', 'F', 'G']:
+            np.testing.assert_allclose(
+                jt.marginal(query).table, brute_force(bn, [query], **evidence))
+
+@pytest.mark.parametrize('q_vars, evidence', QUERIES)
+def test_pruned_query_matches_whole_network(bn, q_vars, evidence):
+    pruned, stats = bn.query(q_vars, return_stats=True, **evidence)
+    bn.prune = False
+    whole, whole_stats = bn.query(q_vars, return_stats=True, **evidence)
+
+    np.testing.assert_allclose(table_in_order(pruned, q_vars), table_in_order(whole, q_vars))
+    assert whole_stats == { 'factors': len(OUTCOME_SPACE), 'pruned': 0 }
+    assert stats['factors'] + stats['pruned'] == len(OUTCOME_SPACE)
+    assert stats['factors'] == len(bn.relevant_nodes(q_vars, evidence))
+
+def test_barren_and_d_separated_nodes_are_pruned(bn):
+    # E, F, G and H are barren: neither queried nor observed, and without kept descendants
+    _, stats = bn.query(['A'], return_stats=True, D='d1')
+    assert sorted(bn.relevant_nodes(['A'], { 'D': 'd1' })) == ['A', 'B', 'C', 'D']
+    assert stats == { 'factors': 4, 'pruned': 4 }
+
+def random_network(rng, n_vars=12, p_edge=0.3) -> BayesNet:
+    '''A random DAG over n_vars variables, with 2 to 4 outcomes each.'''
+    names = [f'V{i}' for i in range(n_vars)]
+    outcome_space = {
+        var: tuple(f'{var}_{k}' for k in range(rng.integers(2, 5))) for var in names }
+    graph = Graph()
+    for var in names:
+        graph.add_node(var)
+    for i, parent in enumerate(names):
+        for child in names[i+1:]:
+            if rng.random() < p_edge:
+                graph.add_edge(parent, child)
+    bn = BayesNet(graph, outcome_space)
+    bn.learnParameters(pd.DataFrame({
+        var: rng.choice(outcomes, size=100) for var, outcomes in outcome_space.items() }))
+    return bn
+
+def naive_greedy_order(bn: BayesNet, edge_weight) -> list:
+    '''_greedy_order without the heap: every fill score is recomputed at every step.'''
+    ig = bn.interactionGraph()
+    position = { var: i for i, var in enumerate(ig) }
+    neighbours = { var: set(ig.children(var)) for var in ig }
+
+    def fill(var):
+        return sum(
+            edge_weight(var1, var2)
+            for var1 in neighbours[var] for var2 in neighbours[var]
+            if position[var1] < position[var2] and var2 not in neighbours[var1])
+
+    order = []
+    while len(neighbours) > 0:
+        var = min(neighbours, key=lambda var: (fill(var), position[var]))
+        order.append(var)
+        adjacent = neighbours.pop(var)
+        for var1 in adjacent:
+            neighbours[var1].discard(var)
+            neighbours[var1].update(adjacent - {var1})
+    return order
+
+@pytest.mark.parametrize('seed', range(5))
+def test_heap_orders_match_naive_greedy(seed):
+    bn = random_network(np.random.default_rng(seed))
+
+    def weight(var1, var2):
+        return len(bn.outcome_space[var1]) * len(bn.outcome_space[var2])
+
+    assert bn.minFill() == naive_greedy_order(bn, lambda var1, var2: 1)
+    assert bn.weightedMinFill() == naive_greedy_order(bn, weight)
+
+@pytest.mark.parametrize('heuristic', ['minDegree', 'minFill', 'weightedMinFill'])
+@pytest.mark.parametrize('q_vars, evidence', QUERIES)
+def test_every_order_gives_the_same_query(bn, heuristic, q_vars, evidence):
+    factors = [f.evidence(**evidence) for f in bn.factors.values()]
+    order = [
+        var for var in getattr(bn, heuristic)(factors) if var not in q_vars and var not in evidence]
+    f = bn.VE(order, factors)
+    for var in f.domain:
+        if var not in q_vars:
+            f = f.marginalize(var)
+    np.testing.assert_allclose(
+        table_in_order(f.normalize(), q_vars), brute_force(bn, q_vars, **evidence))
+
+@pytest.mark.parametrize('seed', range(5))
+def test_cheapest_order_has_the_lowest_cost(seed):
+    bn = random_network(np.random.default_rng(seed))
+    order = bn.cheapestOrder()
+    assert sorted(order) == sorted(bn.factors)
+    assert bn.cost(order) == min(
+        bn.cost(heuristic()) for heuristic in (bn.minDegree, bn.minFill, bn.weightedMinFill))
@@ -0,0 +1,86 @@
+'''
+    Tests of MF_BuildingPredictor: ticks encoded through the sensor schema must give the same
+    evidence codes and predictions as processing the readings one by one.
+'''
+
+import numpy as np
+import pytest
+
+import MF_Utils as Utils
+from MF_BuildingPredictor import BuildingPredictor
+from MF_RoomPredictor import RoomPredictor
+
+ROOM_EVIDENCES = { 'r1': ['motion_sensor1', 'r2_last'], 'r2': ['camera1', 'r1_last'] }
+
+# a raw count of people in each bucket
+RAW_COUNTS = { '0': 0, '<3': 2, '<10': 5, '>=10': 12 }
+
+def make_building(readings) -> BuildingPredictor:
+    readings = readings.assign(
+        r1_last=readings['r1'].shift(1, fill_value='0'),
+        r2_last=readings['r2'].shift(1, fill_value='0'))
+    outcome_space = Utils.bucket_outcomes(list(readings.columns))
+    return BuildingPredictor({
+        room: RoomPredictor(readings, room, sensors, outcome_space)
+        for room, sensors in ROOM_EVIDENCES.items() })
+
+def raw_ticks(rng, n) -> list[dict]:
+    '''Raw sensor dictionaries, with some readings missing or None.'''
+    ticks = []
+    for _ in range(n):
+        tick = {
+            'motion_sensor1': rng.choice(['motion', 'no motion', None]),
+            'camera1': RAW_COUNTS[rng.choice(Utils.PEOPLE_COUNT_BUCKETS)],
+            'robot1': "('r1', 3)",
+        }
+        if rng.random() < 0.2:
+            del tick['camera1']
+        ticks.append(tick)
+    return ticks
+
+@pytest.fixture
+def building(readings) -> BuildingPredictor:
+    return make_building(readings)
+
+def test_schema_codes_match_evidence_codes(building, rng):
+    for tick in raw_ticks(rng, 50):
+        last_indices = rng.integers(len(building.outcomes), size=len(building.rooms))
+        room_codes = building.room_codes(building.encode_tick(tick, last_indices))
+
+        evidence = building.schema.process(tick)
+        for room, i in building.room_index.items():
+            evidence[room + '_last'] = building.outcomes[last_indices[i]]
+        for room, code in zip(building.rooms, room_codes):
+            assert code == building.room_predictors[room].evidence_code(**evidence)
+
+def test_encoded_ticks_predict_like_evidence(readings, rng):
+    encoded = make_building(readings)
+    processed = make_building(readings)
+    for tick in raw_ticks(rng, 50):
+        evidence = processed.schema.process(tick)
+        for room, i in processed.room_index.items():
+            evidence[room + '_last'] = processed.outcomes[processed.mle_indices[i]]
+
+        expected = processed.prediction(threshold=0.9, **evidence)
+        assert encoded.predict_codes(encoded.encode_tick(tick), threshold=0.9) == expected
+        np.testing.assert_allclose(encoded.hmm.states, processed.hmm.states)
+
+def test_online_transitions_need_consecutive_observations(building, rng):
+    predictor = building.room_predictors['r1']
+    ticks = raw_ticks(rng, 6)
+    expected = predictor.transition_counts.copy()
+    num_states = predictor.state_counts.sum()
+
+    # observed at ticks 1, 2, 3 and 5: only 1 -> 2 and 2 -> 3 are transitions
+    observed = { 1: '<3', 2: '<10', 3: '<10', 5: '0' }
+    for tick, sensor_data in enumerate(ticks, start=1):
+        codes = building.encode_tick(sensor_data)
+        building.predict_codes(codes)
+        if tick in observed:
+            building.observe('r1', observed[tick], codes=codes)
+
+    outcomes = building.outcomes
+    expected[outcomes.index('<3'), outcomes.index('<10')] += 1
+    expected[outcomes.index('<10'), outcomes.index('<10')] += 1
+    np.testing.assert_array_equal(predictor.transition_counts, expected)
+    assert predictor.state_counts.sum() == num_states + len(observed)
@@ -0,0 +1,186 @@
+'''
+    Tests of MF_DiscreteFactors: sparse, log-space and copy-free factors against dense factors.
+'''
+
+import numpy as np
+import pytest
+
+from MF_DiscreteFactors import Factor, LogFactor, SparseFactor, logsumexp, outcome_index
+
+OUTCOME_SPACE = {
+    'A': ('a0', 'a1', 'a2'),
+    'B': ('b0', 'b1'),
+    'C': ('c0', 'c1', 'c2', 'c3'),
+    'D': ('d0', 'd1'),
+}
+
+def random_factor(rng, domain) -> Factor:
+    shape = tuple(len(OUTCOME_SPACE[var]) for var in domain)
+    return Factor(domain, OUTCOME_SPACE, table=rng.random(shape))
+
+@pytest.fixture
+def sparse(rng) -> SparseFactor:
+    '''P(C | A, B), with only some (A, B) configurations stored.'''
+    keys = np.array([[0, 1], [2, 0], [1, 1]])
+    values = rng.random((len(keys), 4))
+    default = np.full(4, 0.25)
+    return SparseFactor(('A', 'B'), ('C',), OUTCOME_SPACE, keys, values, default)
+
+def assert_same_factor(f: Factor, expected: Factor) -> None:
+    '''Checks two factors hold the same table, whatever the order of their domains.'''
+    if isinstance(f, SparseFactor):
+        f = f.to_factor()
+    assert set(f.domain) == set(expected.domain)
+    table = np.transpose(f.table, [f.domain.index(var) for var in expected.domain])
+    np.testing.assert_allclose(table, expected.table)
+
+def test_sparse_getitem(sparse):
+    dense = sparse.to_factor()
+    for key in [('a0', 'b1', 'c2'), ('a1', 'b0', 'c0'), ('a2', 'b0', 'c3')]:
+        assert sparse[key] == dense[key]
+
+@pytest.mark.parametrize(
+    'evidence', [{'A': 'a2'}, {'B': 'b1'}, {'C': 'c1'}, {'A': 'a1', 'B': 'b1'}])
+def test_sparse_evidence(sparse, evidence):
+    assert_same_factor(sparse.evidence(**evidence), sparse.to_factor().evidence(**evidence))
+
+@pytest.mark.parametrize('var', ['A', 'B', 'C'])
+def test_sparse_marginalize(sparse, var):
+    assert_same_factor(sparse.marginalize(var), sparse.to_factor().marginalize(var))
+
+@pytest.mark.parametrize(
+    'domain', [('C',), ('D',), ('C', 'D'), ('A', 'D'), ('B', 'C'), ('B', 'A'), ('A', 'B', 'C')])
+def test_sparse_join(rng, sparse, domain):
+    other = random_factor(rng, domain)
+    assert_same_factor(sparse.join(other), sparse.to_factor().join(other))
+    assert_same_factor(other.join(sparse), other.join(sparse.to_factor()))
+
+@pytest.mark.parametrize('variables', [('A',), ('B',), ('B', 'A')])
+def test_sparse_expand(sparse, variables):
+    expanded = sparse.expand(variables)
+    assert expanded.domain[-len(variables) - 1:-1] == variables
+    assert_same_factor(expanded, sparse.to_factor())
+
+def test_sparse_join_on_a_parent_stays_sparse(rng, sparse):
+    joined = sparse.join(random_factor(rng, ('A', 'D')))
+    assert isinstance(joined, SparseFactor)
+    assert joined.sparse_domain == ('B',)
+    # one row per stored value of B, instead of the whole table
+    assert len(joined.keys) == 2
+
+def test_sparse_join_with_sparse_raises(sparse):
+    with pytest.raises(TypeError):
+        sparse.join(sparse)
+
+def test_sparse_normalize(sparse):
+    expected = sparse.to_factor().normalize()
+    assert_same_factor(sparse.copy().normalize(), expected)
+
+def random_log_factor(rng, domain) -> LogFactor:
+    return LogFactor.from_factor(random_factor(rng, domain))
+
+def assert_same_log_factor(f: LogFactor, expected: Factor) -> None:
+    '''Checks a log-space factor holds the log of the dense factor's table.'''
+    assert isinstance(f, LogFactor)
+    assert_same_factor(f.to_factor(), expected)
+
+@pytest.mark.parametrize('var', ['A', 'B', 'C'])
+def test_log_marginalize(rng, var):
+    f = random_log_factor(rng, ('A', 'B', 'C'))
+    assert_same_log_factor(f.marginalize(var), f.to_factor().marginalize(var))
+
+@pytest.mark.parametrize('var', ['A', 'B', 'C'])
+def test_log_maximize(rng, var):
+    f = random_log_factor(rng, ('A', 'B', 'C'))
+    maximized, prev = f.maximize(var, return_prev=True)
+    expected, expected_prev = f.to_factor().maximize(var, return_prev=True)
+    assert_same_log_factor(maximized, expected)
+    np.testing.assert_array_equal(prev, expected_prev)
+
+def test_log_normalize(rng):
+    f = random_log_factor(rng, ('A', 'C'))
+    assert_same_log_factor(f.copy().normalize(), f.to_factor().normalize())
+
+@pytest.mark.parametrize('domain', [('C',), ('B', 'D'), ('A', 'B')])
+def test_log_join(rng, domain):
+    f = random_log_factor(rng, ('A', 'B'))
+    other = random_factor(rng, domain)
+    assert_same_log_factor(f.join(other), f.to_factor().join(other))
+    assert_same_log_factor(other.join(f), other.join(f.to_factor()))
+
+def test_log_factor_keeps_tiny_probabilities(rng):
+    small = Factor(('A',), OUTCOME_SPACE, table=np.array([1e-3, 2e-3, 3e-3]))
+    f = random_log_factor(rng, ('A',))
+    expected = f.table + 400 * np.log(small.table)
+    dense = f.to_factor()
+    for _ in range(400):
+        f = f * small
+        dense = dense * small
+
+    # the dense product underflows to zero, the log-space one does not
+    assert np.all(dense.table == 0)
+    np.testing.assert_allclose(f.normalize().table, expected - logsumexp(expected))
+
+def legacy_evidence(f: Factor, **evidence) -> Factor:
+    '''The original evidence2, which slices a deep copy of the factor.'''
+    f = f.copy()
+    indices = tuple(
+        OUTCOME_SPACE[var].index(evidence[var]) if var in evidence else slice(None)
+        for var in f.domain)
+    f.table = f.table[indices]
+    f.domain = tuple(var for var in f.domain if var not in evidence)
+    return f
+
+@pytest.mark.parametrize('evidence', [{'A': 'a1'}, {'C': 'c3'}, {'A': 'a2', 'C': 'c0'}])
+def test_evidence_matches_legacy(rng, evidence):
+    f = random_factor(rng, ('A', 'B', 'C'))
+    assert_same_factor(f.evidence(**evidence), legacy_evidence(f, **evidence))
+
+def test_evidence_is_a_read_only_view(rng):
+    f = random_factor(rng, ('A', 'B'))
+    reduced = f.evidence(A='a1')
+    assert np.shares_memory(reduced.table, f.table)
+    with pytest.raises(ValueError):
+        reduced.table[0] = 1.0
+
+def test_writes_to_a_reduced_factor_copy_first(rng):
+    f = random_factor(rng, ('A', 'B', 'C'))
+    original = f.table.copy()
+    reduced = f.evidence(A='a1')
+
+    reduced['b0', 'c1'] = 5.0
+    reduced.set_many([('b1', 'c2'), ('b1', 'c3')], [6.0, 7.0])
+    assert reduced['b0', 'c1'] == 5.0
+    np.testing.assert_array_equal(reduced.get_many([('b1', 'c2'), ('b1', 'c3')]), [6.0, 7.0])
+    np.testing.assert_array_equal(f.table, original)
+
+def test_bulk_access_matches_item_access(rng):
+    f = random_factor(rng, ('A', 'B', 'C'))
+    keys = [('a0', 'b1', 'c3'), ('a2', 'b0', 'c0'), ('a0', 'b1', 'c3'), ('a1', 'b1', 'c2')]
+    np.testing.assert_array_equal(f.get_many(keys), [f[key] for key in keys])
+
+    f.set_many(keys[:2], [1.0, 2.0])
+    assert (f[keys[0]], f[keys[1]]) == (1.0, 2.0)
+
+def test_item_access_after_renaming_a_variable(rng):
+    f = random_factor(rng, ('A', 'B'))
+    joined = f * random_factor(rng, ('B', 'C'))
+    assert set(joined.outcome_codes) >= {'A', 'B', 'C'}
+
+    # HiddenMarkovModel.forward renames variables after building a factor
+    outcome_space = dict(OUTCOME_SPACE, A_next=OUTCOME_SPACE['A'])
+    g = Factor(('A_next',), outcome_space, table=rng.random(3))
+    g.domain = ('A',)
+    assert g['a2'] == g.table[2]
+
+def test_joined_codes_match_the_joined_outcome_space(rng):
+    # both factors carry a map for a variable outside their domains, from different outcome spaces
+    f = random_factor(rng, ('B',))
+    f._codes('A')
+    renamed = dict(OUTCOME_SPACE, A=('x0', 'x1', 'x2'))
+    g = Factor(('C',), renamed, table=rng.random(4))
+    g._codes('A')
+
+    for joined in [f * g, g * f]:
+        for var, codes in joined.outcome_codes.items():
+            assert codes == outcome_index(joined.outcome_space[var])
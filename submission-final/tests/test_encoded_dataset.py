@@ -0,0 +1,66 @@
+'''
+    Tests of MF_EncodedDataset: codes against the values they encode, and shared datasets.
+'''
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from MF_EncodedDataset import EncodedDataset
+from MF_RoomPredictor import RoomPredictor
+
+SENSORS = ['motion_sensor1', 'camera1', 'r2']
+
+def decode(dataset: EncodedDataset, column: str) -> list:
+    '''The values of a column, with None for missing values.'''
+    outcomes = dataset.outcome_space[column]
+    return [outcomes[code] if code >= 0 else None for code in dataset[column]]
+
+def test_codes_decode_to_the_values(readings, outcome_space):
+    readings = readings.copy()
+    readings.loc[[3, 50], 'camera1'] = None
+    dataset = EncodedDataset(readings, outcome_space)
+    for column in readings.columns:
+        expected = [None if pd.isna(value) else value for value in readings[column]]
+        assert decode(dataset, column) == expected
+
+def test_columns_are_read_only_views(readings, outcome_space):
+    dataset = EncodedDataset(readings, outcome_space)
+    column = dataset['r1']
+    assert np.shares_memory(column, dataset.codes)
+    with pytest.raises(ValueError):
+        column[0] = 1
+
+def test_codes_of_another_outcome_space(readings, outcome_space):
+    dataset = EncodedDataset(readings, outcome_space)
+    outcomes = ('<10', '0', '<3')
+    codes = dataset.codes_of('r1', outcomes)
+    expected = [outcomes.index(value) if value in outcomes else -1 for value in readings['r1']]
+    np.testing.assert_array_equal(codes, expected)
+
+def test_same_day_pairs(readings, outcome_space):
+    dataset = EncodedDataset(readings, outcome_space, day_lengths=[100, 150, 50])
+    same_day = dataset.same_day_pairs()
+    assert len(same_day) == len(readings) - 1
+    assert np.flatnonzero(~same_day).tolist() == [99, 249]
+
+def test_shared_memory_dataset_matches(readings, outcome_space):
+    dataset = EncodedDataset(readings, outcome_space)
+    block, description = dataset.to_shared_memory()
+    try:
+        attached = EncodedDataset.from_shared_memory(**description)
+        np.testing.assert_array_equal(attached.codes, dataset.codes)
+        assert attached.outcome_space == dataset.outcome_space
+        attached.detach()
+    finally:
+        block.close()
+        block.unlink()
+
+def test_predictors_learn_the_same_from_a_shared_dataset(readings, outcome_space):
+    dataset = EncodedDataset(readings, outcome_space)
+    for room, sensors in [('r1', SENSORS), ('r2', ['camera1', 'r1'])]:
+        from_frame = RoomPredictor(readings, room, sensors, outcome_space)
+        from_dataset = RoomPredictor(dataset, room, sensors, outcome_space)
+        for name in ['state_factor', 'transition_factor', 'emission_factor']:
+            np.testing.assert_array_equal(
+                getattr(from_dataset, name).table, getattr(from_frame, name).table)
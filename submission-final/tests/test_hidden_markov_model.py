@@ -0,0 +1,167 @@
+'''
+    Tests of MF_HiddenMarkovModel against straightforward (unscaled, per-model) implementations.
+'''
+
+from itertools import product
+
+import numpy as np
+import pytest
+
+from MF_DiscreteFactors import Factor
+from MF_HiddenMarkovModel import BatchedHiddenMarkovModel, HiddenMarkovModel, MatrixPowers
+
+STATES = ('s0', 's1', 's2')
+OBSERVATIONS = ('o0', 'o1')
+OUTCOME_SPACE = { 'S': STATES, 'S_next': STATES, 'O': OBSERVATIONS }
+
+def random_rows(rng, shape) -> np.ndarray:
+    '''Random conditional distributions, normalized over the last axis.'''
+    table = rng.random(shape) + 0.05
+    return table / table.sum(axis=-1, keepdims=True)
+
+def make_hmm(rng, log_space=False) -> HiddenMarkovModel:
+    '''A random HMM with 3 states and a binary observation.'''
+    start = Factor(('S',), OUTCOME_SPACE, table=random_rows(rng, 3))
+    transition = Factor(('S', 'S_next'), OUTCOME_SPACE, table=random_rows(rng, (3, 3)))
+    emission = Factor(('S', 'O'), OUTCOME_SPACE, table=random_rows(rng, (3, 2)))
+    return HiddenMarkovModel(start, transition, emission, { 'S_next': 'S' }, log_space)
+
+def likelihood_rows(hmm: HiddenMarkovModel, observations) -> np.ndarray:
+    '''The (steps x states) emission likelihoods of a sequence of observations (None = missing).'''
+    return hmm.emission_matrix(len(observations), O=list(observations))
+
+def test_batched_forward_matches_each_model(rng):
+    hmms = [make_hmm(rng) for _ in range(4)]
+    batched = BatchedHiddenMarkovModel(
+        np.stack([hmm.state.table for hmm in hmms]),
+        np.stack([hmm.transition.table for hmm in hmms]))
+
+    for observations in [('o0', 'o1', None, 'o1'), ('o1', 'o1', 'o0', None)]:
+        likelihoods = np.stack([
+            likelihood_rows(hmm, [obs])[0] for hmm, obs in zip(hmms, observations)])
+        states = batched.forward(likelihoods, normalize=True)
+        for hmm, state, obs in zip(hmms, states, observations):
+            evidence = {} if obs is None else { 'O': obs }
+            np.testing.assert_allclose(state, hmm.forward(normalize=True, **evidence).table)
+
+def test_log_space_forward_matches_probabilities():
+    log_hmm = make_hmm(np.random.default_rng(9418), log_space=True)
+    hmm = make_hmm(np.random.default_rng(9418))
+    for obs in ['o0', None, 'o1', 'o1', None]:
+        evidence = {} if obs is None else { 'O': obs }
+        state = hmm.forward(**evidence).table
+        log_state = log_hmm.forward(**evidence)
+        np.testing.assert_allclose(np.exp(log_state.table), state)
+        np.testing.assert_allclose(log_state.to_factor().table, state)
+
+def brute_force_viterbi(hmm: HiddenMarkovModel, log_likelihoods: np.ndarray) -> list:
+    '''Scores every sequence of states (from the current state onwards) and returns the best.'''
+    log_start = np.log(hmm.state.table)
+    log_transition = np.log(hmm.transition.table)
+    best, best_score = None, -np.inf
+    for path in product(range(len(STATES)), repeat=len(log_likelihoods) + 1):
+        score = log_start[path[0]] + sum(
+            log_transition[i, j] + log_likelihoods[t, j]
+            for t, (i, j) in enumerate(zip(path, path[1:])))
+        if score > best_score:
+            best, best_score = path[1:], score
+    return [STATES[i] for i in best]
+
+def test_viterbi_matches_brute_force(rng):
+    for observations in [('o0',), ('o1', 'o1', 'o0'), ('o0', None, 'o1', 'o1', None, 'o0')]:
+        seed = rng.integers(1 << 30)
+        hmm = make_hmm(np.random.default_rng(seed))
+        log_likelihoods = hmm.emission_matrix(len(observations), log=True, O=list(observations))
+        expected = brute_force_viterbi(hmm, log_likelihoods)
+        assert hmm.viterbi_batch(len(observations), O=list(observations)) == expected
+
+        log_hmm = make_hmm(np.random.default_rng(seed), log_space=True)
+        assert log_hmm.viterbi_decode(log_likelihoods) == expected
+
+def test_forward_batch_matches_repeated_forward(rng):
+    observations = ['o1', None, 'o0', 'o0', None, None, 'o1']
+    for log_space in [False, True]:
+        seed = rng.integers(1 << 30)
+        hmm = make_hmm(np.random.default_rng(seed), log_space)
+        stepped = make_hmm(np.random.default_rng(seed))
+        posteriors, log_likelihood = hmm.forward_batch(len(observations), O=observations)
+
+        for t, obs in enumerate(observations):
+            evidence = {} if obs is None else { 'O': obs }
+            state = stepped.forward(**evidence).table
+            np.testing.assert_allclose(posteriors[t], state / state.sum())
+        np.testing.assert_allclose(log_likelihood, np.log(stepped.state.table.sum()))
+        final = hmm.state.to_factor() if log_space else hmm.state
+        np.testing.assert_allclose(final.table, posteriors[-1])
+
+def test_forward_silent_sees_tables_updated_in_place(rng):
+    hmm = make_hmm(rng)
+    hmm.forward_silent(3)
+
+    # like RoomPredictor.update_factors, write to the tables without replacing the factors
+    hmm.transition.set_index(1, [0.0, 0.0, 1.0])
+    hmm.emission.set_index(2, [0.1, 0.2])
+    hmm.set_factors()
+
+    state = hmm.state.table
+    expected = state
+    for _ in range(3):
+        expected = (expected @ hmm.transition.table) * hmm.emission.table.sum(axis=1)
+    np.testing.assert_allclose(hmm.forward_silent(3).table, expected)
+
+def unscaled_smooth(start, transition, likelihoods) -> tuple[np.ndarray, float]:
+    '''Textbook alpha-beta recursions without scaling, for one model over a short sequence.'''
+    n = len(likelihoods)
+    alphas, betas = [], [np.ones(len(start))]
+    alpha = start
+    for t in range(n):
+        alpha = (alpha @ transition) * likelihoods[t]
+        alphas.append(alpha)
+    for t in range(n - 1, 0, -1):
+        betas.insert(0, transition @ (likelihoods[t] * betas[0]))
+    joint = np.array(alphas) * np.array(betas)
+    return joint / joint.sum(axis=1, keepdims=True), float(np.log(alphas[-1].sum()))
+
+def test_smoothing_matches_unscaled_forward_backward(rng):
+    hmms = [make_hmm(rng) for _ in range(3)]
+    batched = BatchedHiddenMarkovModel(
+        np.stack([hmm.state.table for hmm in hmms]),
+        np.stack([hmm.transition.table for hmm in hmms]))
+    before = batched.states.copy()
+    sequences = [
+        ['o0', 'o1', None, 'o1', 'o0'], [None, None, 'o1', 'o0', 'o0'], ['o1'] * 5]
+    likelihoods = np.stack([
+        likelihood_rows(hmm, sequence) for hmm, sequence in zip(hmms, sequences)], axis=1)
+
+    smoothed, log_likelihoods = batched.smooth(likelihoods)
+    for i, hmm in enumerate(hmms):
+        expected, log_likelihood = unscaled_smooth(
+            hmm.state.table, hmm.transition.table, likelihoods[:, i])
+        np.testing.assert_allclose(smoothed[:, i], expected)
+        np.testing.assert_allclose(log_likelihoods[i], log_likelihood)
+    np.testing.assert_array_equal(batched.states, before)
+
+def test_matrix_powers_match_repeated_products(rng):
+    matrices = np.stack([random_rows(rng, (3, 3)) * rng.random((1, 3)) for _ in range(2)])
+    powers = MatrixPowers(matrices)
+    for k in [1, 2, 3, 7, 8, 13, 37, 64, 5, 1]:
+        scaled, log_scales = powers.power(k)
+        expected = np.stack([np.linalg.matrix_power(matrix, k) for matrix in matrices])
+        np.testing.assert_allclose(scaled * np.exp(log_scales)[:, np.newaxis, np.newaxis], expected)
+    # only the powers of two up to 64 are kept
+    assert len(powers.squares) == 7
+
+def test_high_matrix_powers_keep_their_scale(rng):
+    transition = random_rows(rng, (3, 3))
+    scaled, log_scale = MatrixPowers(transition / 2).power(5000)
+    # (T / 2)^k = T^k / 2^k, where T^k has converged to its stationary rows
+    stationary = np.linalg.matrix_power(transition, 200)
+    np.testing.assert_allclose(scaled, stationary / np.max(stationary))
+    assert log_scale == pytest.approx(5000 * np.log(0.5) + np.log(np.max(stationary)))
+
+def test_zero_matrix_powers_are_zero():
+    matrices = np.stack([np.zeros((2, 2)), np.eye(2)])
+    with np.errstate(all='raise'):
+        scaled, log_scales = MatrixPowers(matrices).power(3)
+    np.testing.assert_array_equal(scaled, matrices)
+    np.testing.assert_array_equal(log_scales, [-np.inf, 0])
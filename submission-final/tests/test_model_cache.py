@@ -0,0 +1,76 @@
+'''
+    Tests of MF_ModelCache: round trips, cache keys and superseded cache files.
+'''
+
+import os
+
+import numpy as np
+
+import MF_ModelCache as ModelCache
+import MF_RoomPredictor
+import MF_Utils as Utils
+from MF_RoomPredictor import RoomPredictor
+
+ROOM_EVIDENCES = { 'r1': ['motion_sensor1', 'r2'], 'r2': ['camera1', 'r1'] }
+
+def train(readings) -> dict[str, RoomPredictor]:
+    outcome_space = Utils.bucket_outcomes(list(readings.columns))
+    return {
+        room: RoomPredictor(readings, room, sensors, outcome_space)
+        for room, sensors in ROOM_EVIDENCES.items() }
+
+def test_loaded_predictors_match_saved(tmp_path, readings):
+    predictors = train(readings)
+    path = os.path.join(tmp_path, 'model_cache_test.npz')
+    ModelCache.save_predictors(path, predictors)
+
+    loaded = ModelCache.load_predictors(path)
+    assert loaded.keys() == predictors.keys()
+    for room, predictor in predictors.items():
+        assert loaded[room].sensors == predictor.sensors
+        for name in ['state_factor', 'transition_factor', 'emission_factor']:
+            np.testing.assert_allclose(
+                getattr(loaded[room], name).table, getattr(predictor, name).table)
+
+def test_cache_key_covers_hyperparameters(tmp_path, monkeypatch):
+    filename = os.path.join(tmp_path, 'day.csv')
+    with open(filename, 'w') as file:
+        file.write('time,r1\n08:00:00,0\n')
+    key = ModelCache.cache_key([filename], ROOM_EVIDENCES)
+    assert ModelCache.cache_key([filename], ROOM_EVIDENCES) == key
+
+    monkeypatch.setattr(MF_RoomPredictor, 'EMISSION_ALPHA', 5)
+    assert ModelCache.cache_key([filename], ROOM_EVIDENCES) != key
+    monkeypatch.undo()
+
+    with open(filename, 'a') as file:
+        file.write('08:00:15,1\n')
+    assert ModelCache.cache_key([filename], ROOM_EVIDENCES) != key
+
+def test_load_or_train_replaces_superseded_caches(tmp_path, readings):
+    calls = []
+    def counted_train():
+        calls.append(None)
+        return train(readings)
+
+    ModelCache.load_or_train(tmp_path, 'a' * 64, counted_train)
+    ModelCache.load_or_train(tmp_path, 'a' * 64, counted_train)
+    assert len(calls) == 1
+
+    ModelCache.load_or_train(tmp_path, 'b' * 64, counted_train)
+    assert len(calls) == 2
+    assert os.listdir(tmp_path) == [os.path.basename(ModelCache.cache_path(tmp_path, 'b' * 64))]
+
+def test_loaded_predictors_keep_learning_online(tmp_path, readings):
+    predictors = train(readings)
+    path = os.path.join(tmp_path, 'model_cache_test.npz')
+    ModelCache.save_predictors(path, predictors)
+    loaded = ModelCache.load_predictors(path)
+
+    for predictor in [predictors['r1'], loaded['r1']]:
+        for outcome in ['<3', '<3', '>=10']:
+            predictor.observe(outcome, np.full(4, 0.25), motion_sensor1='motion', r2='0')
+        predictor.update_factors()
+    for name in ['state_factor', 'transition_factor', 'emission_factor']:
+        np.testing.assert_allclose(
+            getattr(loaded['r1'], name).table, getattr(predictors['r1'], name).table)
@@ -0,0 +1,111 @@
+'''
+    Tests of MF_RoomPredictor: emission lookups and learned factors.
+'''
+
+from itertools import product
+
+import numpy as np
+import pytest
+
+import MF_RoomPredictor
+import MF_Utils as Utils
+from MF_EncodedDataset import EncodedDataset
+from MF_RoomPredictor import RoomPredictor, train_predictors_parallel
+
+SENSORS = ['motion_sensor1', 'camera1', 'r2']
+
+def make_predictor(readings) -> RoomPredictor:
+    return RoomPredictor(readings, 'r1', SENSORS, Utils.bucket_outcomes(list(readings.columns)))
+
+def random_belief(rng) -> np.ndarray:
+    '''A random belief over the people count buckets.'''
+    belief = rng.random(len(Utils.PEOPLE_COUNT_BUCKETS))
+    return belief / belief.sum()
+
+def every_evidence(predictor: RoomPredictor):
+    '''Every combination of evidence of the predictor's sensors, with each sensor maybe missing.'''
+    outcomes = [predictor.outcome_space[var] + (None,) for var in SENSORS]
+    for values in product(*outcomes):
+        yield { var: value for var, value in zip(SENSORS, values) if value is not None }
+
+@pytest.fixture(params=['dense', 'sparse'])
+def predictor(request, monkeypatch, readings) -> RoomPredictor:
+    if request.param == 'sparse':
+        monkeypatch.setattr(MF_RoomPredictor, 'MAX_DENSE_EMISSION_CELLS', 16)
+    return make_predictor(readings)
+
+def test_emission_lookup_matches_factor(predictor):
+    for evidence in every_evidence(predictor):
+        np.testing.assert_allclose(
+            predictor.emission_likelihood(**evidence),
+            predictor._emission_likelihood_from_factor(**evidence))
+
+def test_unseen_sparse_codes_are_bounded(monkeypatch, readings):
+    monkeypatch.setattr(MF_RoomPredictor, 'MAX_DENSE_EMISSION_CELLS', 16)
+    monkeypatch.setattr(MF_RoomPredictor, 'EMISSION_CACHE_SIZE', 5)
+    predictor = make_predictor(readings)
+    num_seen = len(predictor.emission_lookup)
+
+    for evidence in every_evidence(predictor):
+        predictor.emission_likelihood(**evidence)
+    assert len(predictor.emission_lookup) == num_seen
+    assert len(predictor.emission_misses) == 5
+
+def test_parallel_training_matches_serial(readings):
+    room_evidences = { 'r1': ['motion_sensor1', 'r2'], 'r2': ['camera1', 'r1'] }
+    dataset = EncodedDataset(readings, Utils.bucket_outcomes(list(readings.columns)))
+    parallel = train_predictors_parallel(dataset, room_evidences, processes=2)
+
+    assert list(parallel) == list(room_evidences)
+    for room, sensors in room_evidences.items():
+        serial = RoomPredictor(dataset, room, sensors)
+        np.testing.assert_array_equal(parallel[room].transition_counts, serial.transition_counts)
+        np.testing.assert_allclose(
+            parallel[room].emission_factor.table, serial.emission_factor.table)
+
+def test_transitions_are_conditional_on_the_previous_state(readings):
+    predictor = make_predictor(readings)
+    table = predictor.transition_factor.table
+    np.testing.assert_allclose(table.sum(axis=1), 1)
+
+    outcomes = predictor.outcome_space['r1']
+    counts = np.zeros((len(outcomes), len(outcomes)))
+    for previous, current in zip(readings['r1'][:-1], readings['r1'][1:]):
+        counts[outcomes.index(previous), outcomes.index(current)] += 1
+    for i, row in enumerate(counts):
+        # moves weigh their share of all transitions, staying weighs one uniform cell
+        expected = row / counts.sum()
+        expected[i] = 1 / counts.size
+        np.testing.assert_allclose(table[i], expected / expected.sum())
+
+def test_outcomes_never_seen_in_training_get_uniform_rows():
+    outcome_space = { 'r1': ('0', '<3', '<10'), 'r1_next': ('0', '<3', '<10') }
+    counts = np.array([[3, 1, 0], [0, 0, 0], [2, 0, 2]])
+    table = RoomPredictor.transitions_from_counts('r1', outcome_space, counts).table
+    np.testing.assert_allclose(table[1], [1 / 3, 1 / 3, 1 / 3])
+
+    # an outcome seen but never left still stays put
+    counts[1, 1] = 4
+    table = RoomPredictor.transitions_from_counts('r1', outcome_space, counts).table
+    np.testing.assert_allclose(table[1], [0, 1, 0])
+
+def test_online_updates_match_learning_from_counts(predictor, readings, rng):
+    # readings in a new order, so that the observed rows differ from the training ones
+    for _, row in readings.sample(frac=0.3, random_state=1).iterrows():
+        evidence = { var: row[var] for var in SENSORS if rng.random() < 0.9 }
+        predictor.observe(row['r1'], random_belief(rng), **evidence)
+    predictor.update_factors()
+
+    expected = RoomPredictor.from_counts(
+        'r1',
+        SENSORS,
+        predictor.outcome_space,
+        predictor.state_counts,
+        predictor.transition_counts,
+        predictor.emission_counts)
+    for name in ['state_factor', 'transition_factor']:
+        np.testing.assert_allclose(
+            getattr(predictor, name).table, getattr(expected, name).table)
+    for evidence in every_evidence(predictor):
+        np.testing.assert_allclose(
+            predictor.emission_likelihood(**evidence), expected.emission_likelihood(**evidence))
@@ -0,0 +1,82 @@
+'''
+    Tests of MF_StreamingTrainer: training over day files, in chunks or in parallel, must count the
+    same as training once over every day.
+'''
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import MF_Utils as Utils
+from MF_EncodedDataset import EncodedDataset
+from MF_RoomPredictor import RoomPredictor
+from MF_StreamingTrainer import StreamingTrainer
+
+ROOM_EVIDENCES = { 'r1': ['motion_sensor1', 'r2_last'], 'r2': ['camera1', 'r1_last'] }
+COLUMNS = ['r1', 'r2', 'motion_sensor1', 'camera1', 'r1_last', 'r2_last']
+
+def raw_day(rng, n) -> pd.DataFrame:
+    '''A day of raw readings, as found in the CSV logs.'''
+    times = pd.date_range('2024-01-01 08:00:15', periods=n, freq='15s').strftime('%H:%M:%S')
+    return pd.DataFrame({
+        'time': times,
+        'r1': rng.poisson(1.5, size=n),
+        'r2': rng.poisson(4, size=n),
+        'camera1': rng.poisson(4, size=n),
+        'motion_sensor1': rng.choice(['motion', 'no motion'], size=n),
+        'outside': rng.poisson(20, size=n),
+    })
+
+@pytest.fixture
+def day_files(tmp_path, rng) -> list[str]:
+    filenames = []
+    for i, n in enumerate([57, 40, 81]):
+        filename = os.path.join(tmp_path, f'day{i}.csv')
+        raw_day(rng, n).to_csv(filename)
+        filenames.append(filename)
+    return filenames
+
+@pytest.fixture
+def outcome_space(day_files) -> dict[str, tuple]:
+    return Utils.bucket_outcomes(COLUMNS) | Utils.scan_outcomes(day_files, ['motion_sensor1'])
+
+def assert_same_counts(predictor: RoomPredictor, expected: RoomPredictor) -> None:
+    np.testing.assert_array_equal(predictor.state_counts, expected.state_counts)
+    np.testing.assert_array_equal(predictor.transition_counts, expected.transition_counts)
+    for counts, expected_counts in zip(predictor.emission_counts, expected.emission_counts):
+        np.testing.assert_array_equal(counts, expected_counts)
+
+def test_scan_outcomes_reads_the_values_in_the_files(day_files):
+    assert Utils.scan_outcomes(day_files, ['motion_sensor1']) == {
+        'motion_sensor1': ('motion', 'no motion') }
+
+def test_chunked_days_match_one_pass(day_files, outcome_space):
+    days = [
+        Utils.preprocess_readings(pd.read_csv(filename, header=[0], index_col=[0]))
+        for filename in day_files ]
+    dataset = EncodedDataset(
+        pd.concat(days), outcome_space, COLUMNS, [len(day) for day in days])
+
+    trainer = StreamingTrainer(ROOM_EVIDENCES, outcome_space)
+    for filename in day_files:
+        trainer.add_day(filename, chunksize=10)
+    predictors = trainer.predictors()
+
+    for room, sensors in ROOM_EVIDENCES.items():
+        assert_same_counts(predictors[room], RoomPredictor(dataset, room, sensors))
+
+def test_parallel_days_match_serial(day_files, outcome_space):
+    serial = StreamingTrainer(ROOM_EVIDENCES, outcome_space)
+    for filename in day_files:
+        serial.add_day(filename)
+    parallel = StreamingTrainer(ROOM_EVIDENCES, outcome_space)
+    parallel.add_days_parallel(day_files, processes=2)
+
+    assert parallel.num_days == serial.num_days == len(day_files)
+    expected = serial.predictors()
+    for room, predictor in parallel.predictors().items():
+        assert_same_counts(predictor, expected[room])
+        np.testing.assert_allclose(
+            predictor.emission_factor.table, expected[room].emission_factor.table)
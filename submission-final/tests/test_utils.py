@@ -0,0 +1,82 @@
+'''
+    Tests of MF_Utils: counting factors and preprocessing readings.
+'''
+
+from itertools import product
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import MF_Utils as Utils
+from MF_EncodedDataset import EncodedDataset
+
+def legacy_estimate_factor(data, var_name, parent_names, outcome_space, alpha=1) -> np.ndarray:
+    '''The original estimate_factor, which rescans the data once per parent combination.'''
+    var_outcomes = outcome_space[var_name]
+    shape = tuple(len(outcome_space[var]) for var in list(parent_names) + [var_name])
+    table = np.empty(shape)
+    for parent_index in product(*(range(len(outcome_space[var])) for var in parent_names)):
+        rows = np.ones(len(data), dtype=bool)
+        for var, i in zip(parent_names, parent_index):
+            rows &= np.asarray(data[var]) == outcome_space[var][i]
+        for j, outcome in enumerate(var_outcomes):
+            matches = rows & (np.asarray(data[var_name]) == outcome)
+            table[parent_index + (j,)] = (
+                (matches.sum() + alpha) / (rows.sum() + alpha * len(var_outcomes)))
+    return table
+
+def test_estimate_factor_matches_legacy(readings, outcome_space):
+    for parents in ([], ['r2'], ['r2', 'motion_sensor1'], ['camera1', 'r2', 'motion_sensor1']):
+        f = Utils.estimate_factor(readings, 'r1', parents, outcome_space, alpha=2)
+        assert f.domain == tuple(parents + ['r1'])
+        np.testing.assert_allclose(
+            f.table, legacy_estimate_factor(readings, 'r1', parents, outcome_space, alpha=2))
+
+def test_estimate_factor_reads_encoded_datasets(readings, outcome_space):
+    dataset = EncodedDataset(readings, outcome_space)
+    expected = Utils.estimate_factor(readings, 'r1', ['r2', 'camera1'], outcome_space)
+    f = Utils.estimate_factor(dataset, 'r1', ['r2', 'camera1'], outcome_space)
+    np.testing.assert_array_equal(f.table, expected.table)
+
+def test_sparse_factor_matches_dense(readings, outcome_space):
+    parents = ['r2', 'camera1', 'motion_sensor1']
+    dense = Utils.estimate_factor(readings, 'r1', parents, outcome_space, alpha=2)
+    sparse = Utils.estimate_sparse_factor(readings, 'r1', parents, outcome_space, alpha=2)
+    np.testing.assert_allclose(sparse.to_factor().table, dense.table)
+
+def test_sparse_counts_merge_like_one_pass(readings, outcome_space):
+    parents = ['r2', 'camera1']
+    first = Utils.count_sparse_factor(readings.iloc[:120], 'r1', parents, outcome_space)
+    second = Utils.count_sparse_factor(readings.iloc[120:], 'r1', parents, outcome_space)
+    merged = Utils.merge_sparse_counts(first, second)
+    for merged_counts, counts in zip(merged, Utils.count_sparse_factor(
+            readings, 'r1', parents, outcome_space)):
+        np.testing.assert_array_equal(merged_counts, counts)
+
+def test_vectorized_time_buckets_match_scalar():
+    # every hour boundary of the day, and a few times inside the hours
+    times = [f'{hour:02d}:{minute}' for hour in range(8, 19) for minute in ['00:00', '59:59']]
+    times += ['08:00:15', '12:30:00', '18:00:00']
+    buckets = Utils.bucket_times_of_day(pd.Series(times))
+    assert list(buckets) == [Utils.bucket_time_of_day(time) for time in times]
+    assert list(buckets.cat.categories) == list(Utils.TIME_BUCKETS)
+
+@pytest.mark.parametrize('time', ['07:59:59', '19:00:00', '00:00:00', '23:59:59'])
+def test_out_of_range_hours_raise(time):
+    with pytest.raises(ValueError):
+        Utils.bucket_time_of_day(time)
+    with pytest.raises(ValueError):
+        Utils.bucket_times_of_day(pd.Series(['12:00:00', time]))
+
+def test_vectorized_people_buckets_match_scalar():
+    # both sides of every bucket edge
+    counts = [0, 1, 2, 3, 9, 10, 11, 40]
+    buckets = Utils.bucket_people_counts(pd.Series(counts))
+    assert list(buckets) == [Utils.bucket_people_count(count) for count in counts]
+    assert list(buckets.cat.categories) == list(Utils.PEOPLE_COUNT_BUCKETS)
+
+def test_missing_people_counts_stay_missing():
+    buckets = Utils.bucket_people_counts(pd.Series([2, None, 12]))
+    assert buckets.isna().tolist() == [False, True, False]
+    assert buckets[0] == '<3' and buckets[2] == '>=10'